@@ -23,7 +23,7 @@ import pickle
 from loguru import logger
 
 # Local
-from .utils import readJson, loguru_decorator
+from .utils import readJson, replica_config, loguru_decorator
 
 def guided_cmds(cmds: list):
     for cmd in cmds:
@@ -54,35 +54,74 @@ def guided_install():
     response = "ubuntu"
     guided_cmds(cmds[response.lower()])
 
+def mitm_listen_port(cmd: str) -> str:
+    """port given to mitmproxy by -p, --listen-port or --set listen_port= in cmd, None if it uses the default"""
+    args = shlex.split(cmd)
+    for i, arg in enumerate(args):
+        if arg in ("-p", "--listen-port") and i + 1 < len(args):
+            return args[i + 1]
+        elif arg.startswith("--listen-port="):
+            return arg.split("=", 1)[1]
+        elif arg.startswith("listen_port=") and i and args[i - 1] == "--set":
+            return arg.split("=", 1)[1]
+    return None
+
 def guided_setup(config_file: str):
     config = readJson(config_file)
     response = input("\033[92mGenerate mitmproxy addon(s) (yes/NO)?\033[0m ")
     if response.strip().lower().startswith("y"):
         base_path = os.path.dirname(__file__)
-        for mitm in config["mitm_controllers"]:
-            if "addon_name" in config["mitm_controllers"][mitm]:
-                addon_name = config["mitm_controllers"][mitm]["addon_name"]  # could also extract this from the cmd, but they could change the flag at some point and break this then, could also be a user customized module that shouldn't be touched
-                with open(os.path.join(base_path, "mitmproxyaddon.py"), "r") as f:
-                    addon = f.read().replace("MITM_NAME", mitm)
-                    if "rabbit_credentials" in config["mitm_controllers"][mitm]:
-                        addon = addon.replace("RABBIT_CREDENTIALS", config["mitm_controllers"][mitm]["rabbit_credentials"])
-                    else:
-                        addon = addon.replace(", RABBIT_CREDENTIALS", "")
-                    if "addon_protocol" in config["mitm_controllers"][mitm]:
-                        if config["mitm_controllers"][mitm]["addon_protocol"].lower() == "http":
-                            addon = addon.replace("# choose HttpManager() or TcpManager()", "HttpManager()")
-                        elif config["mitm_controllers"][mitm]["addon_protocol"].lower() == "tcp":
-                            addon = addon.replace("# choose HttpManager() or TcpManager()", "TcpManager()")
-                        elif config["mitm_controllers"][mitm]["addon_protocol"].lower() == "udp":
-                            addon = addon.replace("# choose HttpManager() or TcpManager()", "TcpManager()")
-                            addon = addon.replace("tcp", "udp").replace("TCP", "UDP").replace("Tcp", "Udp")
+        # one set of addons per replica, they differ in the broker namespace (and the names/ports if the config uses ${REPLICA} or ${PORT:n})
+        # replicas would overwrite each other's addon or fight over a port if the config doesn't make them differ, so check before writing any
+        addon_names = {}
+        listen_ports = {}
+        for replica in range(config["slime_config"].get("replicas", 1)):
+            replica_conf = replica_config(config, replica)
+            for mitm in replica_conf["mitm_controllers"]:
+                if "addon_name" in replica_conf["mitm_controllers"][mitm]:
+                    addon_name = replica_conf["mitm_controllers"][mitm]["addon_name"]
+                    if addon_name in addon_names:
+                        print("mitmproxy addon %s of %s in replica %s is also used by %s in replica %s, use ${REPLICA} in addon_name and the -s flag of cmd_start" % ((addon_name, mitm, replica) + addon_names[addon_name]), file=sys.stderr)
+                        sys.exit(1)
+                    addon_names[addon_name] = (mitm, replica)
+                port = mitm_listen_port(replica_conf["mitm_controllers"][mitm].get("cmd_start", ""))
+                if port is not None:
+                    if port in listen_ports:
+                        print("mitmproxy port %s of %s in replica %s is also used by %s in replica %s, use ${PORT:%s} in cmd_start" % ((port, mitm, replica) + listen_ports[port] + (port,)), file=sys.stderr)
+                        sys.exit(1)
+                    listen_ports[port] = (mitm, replica)
+        for replica in range(config["slime_config"].get("replicas", 1)):
+            replica_conf = replica_config(config, replica)
+            for mitm in replica_conf["mitm_controllers"]:
+                if "addon_name" in replica_conf["mitm_controllers"][mitm]:
+                    addon_name = replica_conf["mitm_controllers"][mitm]["addon_name"]  # could also extract this from the cmd, but they could change the flag at some point and break this then, could also be a user customized module that shouldn't be touched
+                    with open(os.path.join(base_path, "mitmproxyaddon.py"), "r") as f:
+                        addon = f.read().replace("MITM_NAME", mitm)
+                        if "rabbit_credentials" in replica_conf["mitm_controllers"][mitm]:
+                            rabbit_credentials = replica_conf["mitm_controllers"][mitm]["rabbit_credentials"]
+                            if replica:
+                                # rabbit_credentials is python code for the addon, the namespace is added around it like replica_config does for dicts
+                                rabbit_credentials = "dict(%s, namespace=%r)" % (rabbit_credentials, replica_conf["slime_config"]["broker"]["namespace"])
+                            addon = addon.replace("RABBIT_CREDENTIALS", rabbit_credentials)
+                        elif "broker" in replica_conf["slime_config"] and replica_conf["slime_config"]["broker"]:
+                            addon = addon.replace("RABBIT_CREDENTIALS", repr(replica_conf["slime_config"]["broker"]))
+                        else:
+                            addon = addon.replace(", RABBIT_CREDENTIALS", "")
+                        if "addon_protocol" in replica_conf["mitm_controllers"][mitm]:
+                            if replica_conf["mitm_controllers"][mitm]["addon_protocol"].lower() == "http":
+                                addon = addon.replace("# choose HttpManager() or TcpManager()", "HttpManager()")
+                            elif replica_conf["mitm_controllers"][mitm]["addon_protocol"].lower() == "tcp":
+                                addon = addon.replace("# choose HttpManager() or TcpManager()", "TcpManager()")
+                            elif replica_conf["mitm_controllers"][mitm]["addon_protocol"].lower() == "udp":
+                                addon = addon.replace("# choose HttpManager() or TcpManager()", "TcpManager()")
+                                addon = addon.replace("tcp", "udp").replace("TCP", "UDP").replace("Tcp", "Udp")
+                            else:
+                                print("Invalid protocol specified for mitmproxy addon, must be http or tcp", file=sys.stderr)
+                                sys.exit(1)
                         else:
-                            print("Invalid protocol specified for mitmproxy addon, must be http or tcp", file=sys.stderr)
-                            sys.exit(1)
-                    else:
-                        addon = addon.replace("# choose HttpManager() or TcpManager()", "HttpManager()")
-                with open(addon_name, "w") as f:
-                    f.write(addon)
+                            addon = addon.replace("# choose HttpManager() or TcpManager()", "HttpManager()")
+                    with open(addon_name, "w") as f:
+                        f.write(addon)
         print("\033[94mDone!\033[0m")
     response = input("\033[92mSystem under test setup (build) (yes/NO)?\033[0m ")
     if response.strip().lower().startswith("y"):
@@ -100,6 +139,15 @@ def guided_pre_startup(config_file: str):
     if response.strip().lower().startswith("y"):
         guided_cmds(config["environment_setup"]["startup_cmds"])
 
+def start_local_broker(config):
+    config = readJson(config)
+    if "broker" not in config["slime_config"] or not config["slime_config"]["broker"] or config["slime_config"]["broker"].get("transport") != "local":
+        print("No local broker configured, set slime_config.broker to {\"transport\": \"local\", \"path\": \"slime.sock\"}", file=sys.stderr)
+        return 1
+    from .localbroker import start_broker
+    start_broker(config["slime_config"]["broker"])
+    return 0
+
 def start_statelearner(config):
     config = readJson(config)
     subprocess.run(shlex.split(config["slime_config"]["statelearner_cmd"]))
@@ -131,6 +179,8 @@ def instructions():
        - `slime <config file> --learner-setup`
     3. Run any pre-startup commands (usually just starts rabbitmq in the background, required after system reboot)
        - `slime <config file> --pre-startup`
+       - or if slime_config.broker selects the built-in local broker, start it instead in a separate terminal
+       - `slime <config file> --broker`
     4. Startup mitmproxy controller(s), run each in a separate terminal
        - `slime <config file> -m 0`
        - `slime <config file> -m 1`
@@ -139,6 +189,9 @@ def instructions():
        - `slime <config file> -s 0`
        - `slime <config file> -s 1`
        - `slime <config file> -s ...`
+       - with slime_config.replicas set, also start the mitmproxy and SUT controllers of every other replica
+       - `slime <config file> -m 0 --replica 1`
+       - `slime <config file> -s 0 --replica 1`
     6. Start SLIME in learnlib mode in a separate terminal
        - `slime <config file> -l`
     7. Start statelearner in a separate terminal
@@ -164,6 +217,8 @@ def main() -> int:
                         help="startup system under test (SUT) controller by index")
     parser.add_argument("-ss", action="store", metavar="sut_name", type=str,
                         help="startup system under test (SUT) controller by name")
+    parser.add_argument("--replica", action="store", metavar="replica_index", type=int, default=0,
+                        help="replica of the SUT/mitm environment to start controllers for (see slime_config.replicas)")
     parser.add_argument("-l", action="store_true",
                         help="run slime in learnlib mode")
     parser.add_argument("-r", action="store_true",
@@ -194,6 +249,8 @@ def main() -> int:
                         help="guided startup of environment for SUT (usually just starts rabbitmq)")
     parser.add_argument("--statelearner", action="store_true",
                         help="start statelearner")
+    parser.add_argument("--broker", action="store_true",
+                        help="start the built-in local message broker (replaces rabbitmq when slime_config.broker is {\"transport\": \"local\", ...})")
     args = parser.parse_args()
 
     # args that don't need config
@@ -239,6 +296,8 @@ def main() -> int:
     elif args.statelearner:
         start_statelearner(config_file)
         return 0
+    elif args.broker:
+        return start_local_broker(config_file)
     else:
         from .slime import SLIME
         slime = SLIME(args, config_file, starting_dir)
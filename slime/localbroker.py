@@ -0,0 +1,193 @@
+# Standard library
+import asyncio
+import collections
+import os
+import socket
+import struct
+import threading
+# Local
+from .utils import loguru_decorator
+
+
+# frames are a fixed header followed by the queue name and the message body
+# request: op, timeout (negative for none), queue name length, body length
+# response: status, body length
+REQUEST = struct.Struct("!BdHI")
+RESPONSE = struct.Struct("!BI")
+COUNT = struct.Struct("!I")
+
+OP_PUBLISH = 1
+OP_GET = 2
+OP_CONSUME = 3
+OP_LEN = 4
+OP_PURGE = 5
+
+STATUS_OK = 0
+STATUS_EMPTY = 1
+
+
+def broker_address(broker: dict) -> tuple:
+    """return (family, address) for a broker config entry, a unix socket if path is given, otherwise tcp"""
+    if "path" in broker and broker["path"]:
+        return socket.AF_UNIX, broker["path"]
+    return socket.AF_INET, (broker.get("host", "localhost"), broker.get("port", 5680))
+
+
+class LocalBroker:
+    """minimal in-process message broker with the same queue semantics slime uses from rabbitmq (named fifo queues created on first use)"""
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.waiters = collections.defaultdict(collections.deque)
+
+    def publish(self, queue: str, body: bytes):
+        waiters = self.waiters[queue]
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(body)
+                return
+        self.queues[queue].append(body)
+
+    async def consume(self, queue: str, timeout: float) -> bytes:
+        if self.queues[queue]:
+            return self.queues[queue].popleft()
+        if timeout == 0:
+            return None
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[queue].append(waiter)
+        await asyncio.wait({waiter}, timeout=timeout)
+        if waiter.done():
+            return waiter.result()
+        waiter.cancel()
+        try:
+            self.waiters[queue].remove(waiter)
+        except ValueError:
+            pass
+        return None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                op, timeout, qname_len, body_len = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+                queue = (await reader.readexactly(qname_len)).decode()
+                body = await reader.readexactly(body_len)
+                if timeout < 0:
+                    timeout = None
+                if op == OP_PUBLISH:
+                    self.publish(queue, body)
+                    writer.write(RESPONSE.pack(STATUS_OK, 0))
+                elif op == OP_GET or op == OP_CONSUME:
+                    body = await self.consume(queue, 0 if op == OP_GET else timeout)
+                    if body is None:
+                        writer.write(RESPONSE.pack(STATUS_EMPTY, 0))
+                    elif writer.is_closing() or reader.at_eof():
+                        # client went away while waiting, put the message back at the front so it is not lost
+                        self.queues[queue].appendleft(body)
+                        break
+                    else:
+                        writer.write(RESPONSE.pack(STATUS_OK, len(body)) + body)
+                elif op == OP_LEN:
+                    writer.write(RESPONSE.pack(STATUS_OK, COUNT.size) + COUNT.pack(len(self.queues[queue])))
+                elif op == OP_PURGE:
+                    count = len(self.queues[queue])
+                    self.queues[queue].clear()
+                    writer.write(RESPONSE.pack(STATUS_OK, COUNT.size) + COUNT.pack(count))
+                else:
+                    raise ValueError("Invalid broker op: %s" % op)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, broker: dict):
+        family, address = broker_address(broker)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.remove(address)
+            server = await asyncio.start_unix_server(self.handle, path=address)
+        else:
+            server = await asyncio.start_server(self.handle, host=address[0], port=address[1])
+        async with server:
+            await server.serve_forever()
+
+
+@loguru_decorator
+def start_broker(broker: dict):
+    print("STARTING BROKER: %s" % str(broker_address(broker)[1]))
+    try:
+        asyncio.run(LocalBroker().serve(broker))
+    except KeyboardInterrupt:
+        pass
+
+
+class LocalTransport:
+    """client for LocalBroker, one blocking socket per thread like the pika transport"""
+    def __init__(self, broker: dict):
+        self.family, self.address = broker_address(broker)
+        self.local = threading.local()
+
+    def connect(self) -> socket.socket:
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(self.family, socket.SOCK_STREAM)
+            sock.connect(self.address)
+            if self.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.local.sock = sock
+            self.local.reader = sock.makefile("rb")
+        return sock
+
+    def close(self):
+        sock = getattr(self.local, "sock", None)
+        self.local.sock = None
+        if sock is not None:
+            self.local.reader.close()
+            sock.close()
+
+    def request(self, op: int, queue: str, body: bytes = b"", timeout: float = None) -> tuple:
+        qname = queue.encode()
+        frame = REQUEST.pack(op, -1.0 if timeout is None else timeout, len(qname), len(body)) + qname + body
+        for attempt in range(2):
+            try:
+                self.connect().sendall(frame)
+                break
+            except OSError:
+                # reconnect once, eg broker restarted between sessions
+                self.close()
+                if attempt:
+                    raise
+        # the broker may have acted on the frame by now, sending it again could publish twice or lose a message
+        try:
+            header = self.local.reader.read(RESPONSE.size)
+            if len(header) < RESPONSE.size:
+                raise ConnectionError("broker closed the connection")
+            status, body_len = RESPONSE.unpack(header)
+            return status, self.local.reader.read(body_len)
+        except OSError:
+            self.close()
+            raise
+
+    def publish(self, queue: str, body: bytes, declare: bool = True):
+        # queues are created on first use, there is nothing to declare
+        self.request(OP_PUBLISH, queue, body)
+
+    def private(self, queue: str, expires: int = None):
+        # reply queues live as long as the broker, the caller drains them
+        pass
+
+    def get(self, queue: str) -> bytes:
+        status, body = self.request(OP_GET, queue)
+        return body if status == STATUS_OK else None
+
+    def consume(self, queue: str, timeout: float = None) -> bytes:
+        status, body = self.request(OP_CONSUME, queue, timeout=timeout)
+        return body if status == STATUS_OK else None
+
+    def length(self, queue: str) -> int:
+        status, body = self.request(OP_LEN, queue)
+        return COUNT.unpack(body)[0]
+
+    def purge(self, queue: str) -> int:
+        status, body = self.request(OP_PURGE, queue)
+        return COUNT.unpack(body)[0]
@@ -1,33 +1,63 @@
+import time
 from .utils import loguru_decorator
 from .msgbroker import Bugs
 from .mitmproxyctrl import MitmCtrl
 from .msgparser import MessageParserData, select_msgparser
 from .msgfuzzer import MessageFuzzerData, select_msgfuzzer
 
+# commands the mitm turns into allowreq/allowres for each message type, ie the message is passed on unchanged
+PASSTHROUGH = {
+    "request": ["allow", "allowreq", "killres"],
+    "response": ["allow", "allowres", "lowergetreq"]
+}
+
+# seconds between checks whether a speculative session was aborted while listening
+ABORT_POLL = 0.05
+
 class MitmManager:
     # todo: combine with mitmproxyctrl
     @loguru_decorator
-    def __init__(self, config:dict, user_module = None):
+    def __init__(self, config:dict, user_module = None, parser_data:MessageParserData = None):
         self.config = config
-        self.controller = MitmCtrl()
+        self.controller = MitmCtrl(config["slime_config"].get("broker"))
         self.parsers = {}
-        self.parser_data = MessageParserData()
+        # replicas pass in the parser data of the first mitm manager so they all share one output alphabet
+        self.parser_data = parser_data or MessageParserData()
         self.fuzzers = {}
-        self.fuzzer_data = MessageFuzzerData()
+        self.fuzzer_data = MessageFuzzerData(config["slime_config"].get("plaid_mode", "symbolic"))
         self.last_mitm = ""
         self.timeout = config["slime_config"]["mitm_timeout"]
         self.ludicrous_speed = config["slime_config"]["ludicrous_speed"]
+        # whether the last action passed the message on unchanged and another one came back (None if it changed or dropped it)
+        self.forwarded = None
+        # LatencyModel for adaptive timeouts, and the query prefix the current action follows
+        self.latency = None
+        self.prefix = ""
+        # QuiescenceDetector and the function sampling the activity of the SUTs, to stop listening early once they went quiet
+        self.quiescence = None
+        self.activity = None
+        # abort event of the speculative session running on this replica, listening gives up once it's set so the learner gets the replica without waiting for a timeout
+        self.abort = None
+        # fuzzers for dry runs have their own data so they never touch the running session
+        self.dry_run_data = MessageFuzzerData()
+        self.dry_run_fuzzers = {}
         for mitm_name in config["mitm_controllers"]:
             self.parsers[mitm_name] = select_msgparser(self.parser_data, config["mitm_controllers"][mitm_name]["msg_parser"], user_module)
             self.fuzzers[mitm_name] = select_msgfuzzer(self.fuzzer_data, config["mitm_controllers"][mitm_name]["msg_fuzzer"], user_module)
+            if config["slime_config"].get("dry_run"):
+                self.dry_run_fuzzers[mitm_name] = select_msgfuzzer(self.dry_run_data, config["mitm_controllers"][mitm_name]["msg_fuzzer"], user_module)
 
     @loguru_decorator
     def clearFlows(self):
         self.controller.clearFlows()
 
     @loguru_decorator
-    def clearQueues(self):
-        self.controller.clearQueues()
+    def clearQueues(self) -> int:
+        return self.controller.clearQueues()
+
+    @loguru_decorator
+    def drainFlows(self, quiet: float, timeout: float) -> int:
+        return self.controller.drainFlows(quiet, timeout)
 
     @loguru_decorator
     def reset(self):
@@ -36,7 +66,9 @@ class MitmManager:
         # could be nothing if using sut_cmd in the alphabet (implement flag for this later)
         self.timeout = self.config["slime_config"]["mitm_timeout"]
         self.fuzzer_data.new_session()
-        msg_out = self.controller.listen(self.timeout)  # WARNING, if this times out msg_out["mitm"] will be None, raising an exception in process_msg()
+        msg_out = self.wait(self.timeout)  # WARNING, if this times out msg_out["mitm"] will be None, raising an exception in process_msg()
+        if self.aborted():
+            return
         self.process_msg(msg_out, "slime_session_reset")
 
     @loguru_decorator
@@ -44,10 +76,81 @@ class MitmManager:
         return self.fuzzers[self.last_mitm].fuzz(cmd)
 
     @loguru_decorator
-    def query_mitm(self, cmd: str):
-        flag, cmd, extras = self.fuzz(cmd)
-        self.controller.send(cmd, extras)
-        return flag, self.controller.listen(self.timeout)
+    def dry_run(self, cmd: str, session_history: list) -> tuple:
+        """(return code, whether the message is passed on unchanged) of the fuzzer for cmd on the last message of a recorded session history
+        the fuzzer has to decide from the session history alone, which simple_fuzzer does"""
+        self.dry_run_data.session_history[:] = session_history
+        self.dry_run_data.plaid_msg.clear()
+        last = session_history[-1]
+        return_code, replace_flag, new_cmd, extras = self.dry_run_fuzzers[last["mitm_name"]].fuzzer(cmd)
+        return return_code, not replace_flag and (cmd if new_cmd is None else new_cmd) in PASSTHROUGH[last["type"]]
+
+    @loguru_decorator
+    def query_mitm(self, cmd: str, stage: int = 0):
+        flag, msg_cmd, extras = self.fuzz(cmd)
+        self.controller.send(msg_cmd, extras)
+        if self.latency is None:
+            return flag, self.listen(self.timeout)
+        timeout = self.timeout
+        if timeout == self.config["slime_config"]["mitm_timeout"]:
+            timeout = self.latency.timeout(self.prefix, cmd, stage, timeout, self.config["slime_config"]["noflow_timeout"])
+        start = time.perf_counter()
+        msg_out = self.listen(timeout)
+        if self.aborted():
+            # cut short, says nothing about the latency
+            pass
+        elif msg_out["type"] == "timeout":
+            self.latency.timed_out(self.timeout - timeout)
+        else:
+            self.latency.observe(self.prefix, cmd, stage, time.perf_counter() - start)
+        return flag, msg_out
+
+    @loguru_decorator
+    def listen(self, timeout: float) -> dict:
+        """listen for the next message from the mitm, a timeout comes early if the quiescence detector sees the SUTs went quiet
+        the queue is polled in short slices with the SUTs sampled in between, the decision is only taken once nothing moved for several samples"""
+        if self.quiescence is None or self.activity is None:
+            return self.wait(timeout)
+        start = time.monotonic()
+        deadline = start + timeout
+        before = None
+        quiet = 0
+        while True:
+            msg_out = self.controller.listen(max(0, min(self.quiescence.interval, deadline - time.monotonic())))
+            if msg_out["type"] != "timeout" or time.monotonic() >= deadline or self.aborted():
+                return msg_out
+            after = self.activity()
+            if before is None and any(activity is None for activity in after.values()):
+                # a SUT controller that can't sample its processes gives no evidence, wait for the timeout as usual
+                return self.wait(max(0, deadline - time.monotonic()))
+            # a forwarded http request without its response yet means the SUT is busy even if its processes don't show it, eg waiting on something outside of them
+            quiet = quiet + 1 if self.quiescence.quiet(before, after) and not self.controller.open_flows else 0
+            before = after
+            if self.quiescence.decide(quiet, time.monotonic() - start):
+                break
+        if self.quiescence.verify():
+            msg_out = self.wait(max(0, deadline - time.monotonic()))
+            if self.aborted():
+                return msg_out
+            self.quiescence.verified(msg_out["type"] != "timeout")
+            return msg_out
+        self.quiescence.decided(deadline - time.monotonic())
+        return msg_out
+
+    @loguru_decorator
+    def aborted(self) -> bool:
+        return self.abort is not None and self.abort.is_set()
+
+    @loguru_decorator
+    def wait(self, timeout: float) -> dict:
+        """listen on the mitm controller, in short slices during a speculative session so a timeout comes as soon as it is aborted"""
+        if self.abort is None:
+            return self.controller.listen(timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            msg_out = self.controller.listen(max(0, min(ABORT_POLL, deadline - time.monotonic())))
+            if msg_out["type"] != "timeout" or time.monotonic() >= deadline or self.abort.is_set():
+                return msg_out
 
     @loguru_decorator
     def process_msg(self, msg_out: dict, cmd: str):
@@ -65,6 +168,7 @@ class MitmManager:
     @loguru_decorator
     def process_action(self, cmd) -> str:
         flag, msg_out = self.query_mitm(cmd)
+        self.forwarded = msg_out["type"] != "timeout" if self.controller.last_sent in ["allowreq", "allowres"] else None
         output_return_code = flag  # default = 0 = action success
         output_symbol_response = "null"
         output_symbol_request = "null"
@@ -80,7 +184,7 @@ class MitmManager:
                 output_symbol_response = self.process_msg(msg_out, cmd)
             elif msg_out["type"] == "error":
                 output_symbol_response = "proxyerror"
-            flag, msg_out = self.query_mitm(cmd)
+            flag, msg_out = self.query_mitm(cmd, 1)
             output_return_code += flag
             if msg_out["type"] == "timeout":
                 # may be likely to be noflow for the rest of the current session
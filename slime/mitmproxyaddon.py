@@ -2,7 +2,6 @@
 import time
 import threading
 import typing
-import pickle
 # Third party
 import mitmproxy
 import mitmproxy.addonmanager
@@ -28,6 +27,7 @@ class HttpManager:
             self.filter_domains = False
         # help with non-determinism issues if another request comes in after the last was sent out and waiting for a probable reply
         self.timeout = 4  # time to wait until deciding the last response timed out/is dead
+        self.reply_timeout = 60  # time to wait for a command from slime before passing the flow on unchanged, eg its message was cleared from the queue, mitmproxy is blocked meanwhile
         self.lock = threading.Lock()
         # TODO, this lock is better since it can be shared accross multiple mitm, and not sure how mitmproxy does it's threading, this should be more reliable
         # import filelock
@@ -50,7 +50,7 @@ class HttpManager:
         msg_out = {
             "type": "request",
             "mitm": self.name,
-            "msg": str(flow.request.get_text()),
+            "msg": flow.request.get_content(strict=False),
             "cookies": [(k, v) for k, v in flow.request.cookies.items(multi=True)],
             "headers": [(k, v) for k, v in flow.request.headers.items(multi=True)],
             "authority": flow.request.authority,
@@ -61,11 +61,16 @@ class HttpManager:
             "path": flow.request.path
         }
         self.lock.acquire(blocking=True, timeout=self.timeout)
-        self.q.send(pickle.dumps(msg_out, 0).decode())
-        msg_pickle = self.q.listen()
-        msg_in = pickle.loads(msg_pickle.encode())
+        # each flow waits for the reply to its own message, replies are matched by correlation id so concurrent flows cannot swap commands
+        msg_in = self.q.request(msg_out, self.reply_timeout)
+        if msg_in == "TIMEOUT":
+            try:
+                self.lock.release()
+            except:
+                pass
+            flow.resume()
+            return None
         if msg_in["type"] == "clear_flows":
-            self.q.requeue(msg_pickle)
             # self.q.send("ack_clear_flows")
             self.lock.release()
             return None
@@ -78,12 +83,12 @@ class HttpManager:
             self.lock.release()
         elif msg_in["msg"] == "replacereq":
             msg = msg_in["msg+"]
-            flow.request.set_text(msg)
+            flow.request.set_content(msg)
             if "cookies" in msg_in:
                 flow.request.cookies.clear()
                 for key, value in msg_in["cookies"]:
                     flow.request.cookies.add(key, value)
-            # self.q.requeue(msg_pickle)
+            # self.q.requeue(msg_in)
         elif msg_in["msg"] == "lowergetreq":
             class _SubRequest(mitmproxy.http.HTTPRequest):
                 method = "get"
@@ -91,7 +96,7 @@ class HttpManager:
             flow.request.data.method = b"get"
         elif msg_in["msg"] == "allowreq":
             # nothing to do here, requeue cmd for response
-            # self.q.requeue(msg_pickle)
+            # self.q.requeue(msg_in)
             pass  # no longer requeue, will ask again at next stage
         else:
             self.q.send("ERROR")
@@ -108,19 +113,18 @@ class HttpManager:
         msg_out = {
             "type": "response",
             "mitm": self.name,
-            "msg": str(flow.response.get_text()),
+            "msg": flow.response.get_content(strict=False),
             "cookies": [(k, v) for k, v in flow.response.cookies.items(multi=True)],
             "headers": [(k, v) for k, v in flow.response.headers.items(multi=True)]
         }
-        self.q.send(pickle.dumps(msg_out, 0).decode())
-        msg_pickle = self.q.listen()
+        msg_in = self.q.request(msg_out, self.reply_timeout)
         try:
             self.lock.release()
         except:
             pass
-        msg_in = pickle.loads(msg_pickle.encode())
+        if msg_in == "TIMEOUT":
+            return None
         if msg_in["type"] == "clear_flows":
-            self.q.requeue(msg_pickle)
             # self.q.send("ack_clear_flows")
             return None
         if msg_in["mitm"] != self.name or msg_in["type"] != "cmd":
@@ -130,7 +134,7 @@ class HttpManager:
             flow.kill()
         elif msg_in["msg"] == "replaceres":
             msg = msg_in["msg+"]
-            flow.response.set_text(msg)
+            flow.response.set_content(msg)
         elif msg_in["msg"] == "allowres":
             # flow completed
             pass
@@ -147,6 +151,7 @@ class TcpManager:
         self.name = "MITM_NAME"
         # help with non-determinism issues if another request comes in after the last was sent out and waiting for a probable reply
         self.timeout = 4  # time to wait until deciding the last response timed out/is dead
+        self.reply_timeout = 60  # time to wait for a command from slime before passing the flow on unchanged, eg its message was cleared from the queue, mitmproxy is blocked meanwhile
         self.lock = threading.Lock()
         # TODO, this lock is better since it can be shared accross multiple mitm, and not sure how mitmproxy does it's threading, this should be more reliable
         # import filelock
@@ -172,7 +177,7 @@ class TcpManager:
             msg_out = {
                 "type": "request",
                 "mitm": self.name,
-                "msg": str(flow.messages[-1].content.decode()),
+                "msg": flow.messages[-1].content,
                 "cookies": [],
                 "headers": [],
                 "authority": "",
@@ -183,11 +188,15 @@ class TcpManager:
                 "path": ""
             }
             self.lock.acquire(blocking=True, timeout=self.timeout)
-            self.q.send(pickle.dumps(msg_out, 0).decode())
-            msg_pickle = self.q.listen()
-            msg_in = pickle.loads(msg_pickle.encode())
+            msg_in = self.q.request(msg_out, self.reply_timeout)
+            if msg_in == "TIMEOUT":
+                try:
+                    self.lock.release()
+                except:
+                    pass
+                flow.resume()
+                return None
             if msg_in["type"] == "clear_flows":
-                self.q.requeue(msg_pickle)
                 # self.q.send("ack_clear_flows")
                 self.lock.release()
                 return None
@@ -200,11 +209,11 @@ class TcpManager:
                 self.lock.release()
             elif msg_in["msg"] == "replacereq":
                 msg = msg_in["msg+"]
-                flow.messages[-1].content = msg.encode()
-                # self.q.requeue(msg_pickle)
+                flow.messages[-1].content = msg
+                # self.q.requeue(msg_in)
             elif msg_in["msg"] == "allowreq":
                 # nothing to do here, requeue cmd for response
-                # self.q.requeue(msg_pickle)
+                # self.q.requeue(msg_in)
                 pass  # no longer requeue, will ask again at next stage
             else:
                 self.q.send("ERROR")
@@ -213,19 +222,18 @@ class TcpManager:
             msg_out = {
                 "type": "response",
                 "mitm": self.name,
-                "msg": str(flow.messages[-1].content.decode()),
+                "msg": flow.messages[-1].content,
                 "cookies": [],
                 "headers": []
             }
-            self.q.send(pickle.dumps(msg_out, 0).decode())
-            msg_pickle = self.q.listen()
+            msg_in = self.q.request(msg_out, self.reply_timeout)
             try:
                 self.lock.release()
             except:
                 pass
-            msg_in = pickle.loads(msg_pickle.encode())
+            if msg_in == "TIMEOUT":
+                return None
             if msg_in["type"] == "clear_flows":
-                self.q.requeue(msg_pickle)
                 # self.q.send("ack_clear_flows")
                 return None
             if msg_in["mitm"] != self.name or msg_in["type"] != "cmd":
@@ -235,7 +243,7 @@ class TcpManager:
                 flow.kill()
             elif msg_in["msg"] == "replaceres":
                 msg = msg_in["msg+"]
-                flow.messages[-1].content = msg.encode()
+                flow.messages[-1].content = msg
             elif msg_in["msg"] == "allowres":
                 # flow completed
                 pass
@@ -7,18 +7,19 @@ import os
 import pickle
 # Third party
 import psutil
+from loguru import logger
 from mitmproxy import proxy, options
 from mitmproxy.tools.dump import DumpMaster
 from mitmproxy.addons import core
 # Local
 from .msgbroker import Bugs
-from .utils import writeCsv, writeJson, loguru_decorator
+from .utils import writeCsv, writeJson, wait_until, loguru_decorator
 
 
 @loguru_decorator
-def start_mitm(config):
+def start_mitm(config, broker: dict = None):
     if "restart_between_sessions" in config and config["restart_between_sessions"]:
-        q = Bugs("mitm_process_ctrl", True)
+        q = Bugs("mitm_process_ctrl", True, broker)
         q.initQueues()
         q.clear()
         signal.signal(signal.SIGINT, lambda *args: q.requeue("terminate"))
@@ -27,12 +28,11 @@ def start_mitm(config):
             if msg == "stop":
                 p.send_signal(signal.SIGINT)
                 p.wait()
-                q.send("stopped")
+                q.reply("stopped")
             elif msg == "start":
                 p = subprocess.Popen(shlex.split(config["cmd_start"]))
-                while not psutil.Process(p.pid).connections():
-                    time.sleep(0.1)
-                q.send("started")
+                wait_until(psutil.Process(p.pid).connections)
+                q.reply("started")
             elif msg == "terminate":
                 p.send_signal(signal.SIGINT)
                 p.wait()
@@ -44,23 +44,69 @@ def start_mitm(config):
 
 class MitmCtrl:
     @loguru_decorator
-    def __init__(self):
-        self.q = Bugs("mitm", True)
+    def __init__(self, broker: dict = None):
+        self.q = Bugs("mitm", True, broker)
         self.q.initQueues()
         self.q.clear()
         self.last_mitm = ""
         self.last_msg_type = ""
+        # addons generated from an older template send text pickles (protocol 0) and expect them back, answer in whichever format was last received
+        self.legacy_addon = False
+        # (reply queue, correlation id) of flows in the addon still waiting for a command, the current one is answered by send() and the rest by clearFlows()
+        self.current = None
+        self.unanswered = []
+        self.last_sent = None
+        # http requests forwarded to the server whose response hasn't come back yet, the SUT is still working on them (tcp messages don't always get one)
+        self.open_flows = 0
+        self.last_http = False
+
+    def pack(self, msg_in: dict):
+        if self.legacy_addon:
+            if "msg+" in msg_in and type(msg_in["msg+"]) == bytes:
+                msg_in["msg+"] = msg_in["msg+"].decode("utf-8", "surrogateescape")
+            return pickle.dumps(msg_in, 0).decode()
+        return msg_in
 
     @loguru_decorator
-    def clearQueues(self):
-        self.q.clear()
+    def clearQueues(self) -> int:
+        """drop everything queued from the addon, returns how many messages that were
+        the flows behind them block mitmproxy until they get a reply, so they are read and released with clear_flows rather than purged"""
+        count = self.q.clear(recvq=False)
+        while self.q.get() is not None:
+            count += 1
+            self.release(self.q.last_reply_to, self.q.last_corr_id)
+        return count
+
+    @loguru_decorator
+    def drainFlows(self, quiet: float, timeout: float) -> int:
+        """like clearQueues, but keep releasing messages as they arrive until none did for quiet seconds, or for at most timeout seconds, returns how many there were"""
+        count = self.q.clear(recvq=False)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.q.listen(min(quiet, deadline - time.monotonic())) == "TIMEOUT":
+                break
+            count += 1
+            self.release(self.q.last_reply_to, self.q.last_corr_id)
+        return count
+
+    @loguru_decorator
+    def release(self, reply_to: str, corr_id: int):
+        """answer a flow with clear_flows, messages of legacy addons have no reply queue and are just dropped"""
+        if reply_to:
+            self.q.reply(self.pack({"type": "clear_flows"}), reply_to, corr_id)
 
     @loguru_decorator
     def clearFlows(self):
         msg_out = {
             "type": "clear_flows"
         }
-        self.q.send(pickle.dumps(msg_out, 0).decode())
+        if self.legacy_addon:
+            self.q.send(self.pack(msg_out))
+        for reply_to, corr_id in self.unanswered:
+            self.release(reply_to, corr_id)
+        self.unanswered = []
+        self.current = None
+        self.open_flows = 0
         # if self.last_msg_type in ["request"]:
         #     while self.q.listen() != "ack_clear_flows":
         #         pass
@@ -68,7 +114,6 @@ class MitmCtrl:
     @loguru_decorator
     def send(self, cmd: str, extras: dict):
         """create input message for mitmproxyaddon from cmd"""
-        self.q.clear()
         msg_in = {
             "type": "cmd",
             "mitm": self.last_mitm
@@ -86,7 +131,7 @@ class MitmCtrl:
                 msg_in["msg"] = "allowreq"
             elif cmd.startswith("replace:"):
                 msg_in["msg"] = "replacereq"
-                msg_in["msg+"] = cmd[8:]
+                msg_in["msg+"] = cmd[8:].encode("utf-8", "surrogateescape")
                 if "cookies" in extras:
                     msg_in["cookies"] = extras["cookies"]
             else:
@@ -101,19 +146,38 @@ class MitmCtrl:
                 msg_in["msg"] = "allowres"
             elif cmd.startswith("replace:"):
                 msg_in["msg"] = "replaceres"
-                msg_in["msg+"] = cmd[8:]
+                msg_in["msg+"] = cmd[8:].encode("utf-8", "surrogateescape")
             else:
                 raise Exception("Invalid command for mitm: %s" % cmd)
         # elif self.last_msg_type == "timeout":
         #     msg_in["msg"] = "unknown"  # this will cause an error if the SUT wakes up, otherwise it is harmless for completing the current session
-        self.q.send(pickle.dumps(msg_in, 0).decode())
+        self.last_sent = msg_in["msg"]
+        if self.last_msg_type == "request" and self.last_http and msg_in["msg"] != "killreq":
+            self.open_flows += 1
+        if self.current is None:
+            # only legacy addons read commands from the queue, the current addon gets them as the reply to its flow and has none waiting after a timeout
+            if self.legacy_addon:
+                self.q.send(self.pack(msg_in))
+            elif self.last_msg_type != "timeout":
+                logger.error("no flow of %s to send %s to" % (self.last_mitm, msg_in["msg"]))
+        else:
+            self.q.reply(self.pack(msg_in), *self.current)
+            self.unanswered.remove(self.current)
+            self.current = None
 
     @loguru_decorator
     def listen(self, timeout = None) -> dict:
         """get output message from mitmproxyaddon"""
         msg_out = self.q.listen(timeout)
-        self.q.clear()
-        if msg_out in ["TIMEOUT", "ERROR"]:
+        self.current = None
+        if self.q.last_reply_to:
+            self.current = (self.q.last_reply_to, self.q.last_corr_id)
+            self.unanswered.append(self.current)
+        # other flows that arrived meanwhile are dropped like before, but they are remembered so clearFlows() can release them
+        while self.q.get() is not None:
+            if self.q.last_reply_to:
+                self.unanswered.append((self.q.last_reply_to, self.q.last_corr_id))
+        if type(msg_out) == str and msg_out in ["TIMEOUT", "ERROR"]:
             # likely to be noflow for the rest of the current session (since no REQUEST or response in queue)
             # responses can be skipped/null, but that won't cause a timeout because listen would grab the next request, that being null would need a SUT input command to restart 
             self.last_msg_type = msg_out.lower()
@@ -123,16 +187,24 @@ class MitmCtrl:
                 "msg": "MITM_" + msg_out
             }
         else:
-            msg_out = pickle.loads(msg_out.encode())
+            self.legacy_addon = type(msg_out) == str
+            if self.legacy_addon:
+                msg_out = pickle.loads(msg_out.encode())
+            if type(msg_out["msg"]) == bytes:
+                # raw body from the addon, decoded once here for the parsers and fuzzers (surrogateescape so replaying it gives back the same bytes)
+                msg_out["msg"] = msg_out["msg"].decode("utf-8", "surrogateescape")
             self.last_mitm = msg_out["mitm"]
             self.last_msg_type = msg_out["type"]
+            # only http requests have a url, a forwarded request that errors upstream stays open until clearFlows(), which just means waiting the full timeout like before
+            self.last_http = bool(msg_out.get("url"))
+            if self.last_msg_type == "response":
+                self.open_flows = max(0, self.open_flows - 1)
         return msg_out
 
     @loguru_decorator
     def getQLog(self):
-        # need to uncomment code for logAppend in msgbroker
         return self.q.getLog()
 
     @loguru_decorator
-    def writeQLog(self, time = False):
-        self.q.writeLog()
+    def writeQLog(self, time = False, binary = False):
+        self.q.writeLog(time, binary)
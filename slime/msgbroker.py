@@ -1,44 +1,183 @@
 # Standard library
+import asyncio
+import concurrent.futures
 import time
 import csv
+import collections
+import itertools
+import lzma
+import pickle
+import selectors
+import signal
 import socket
+import struct
+import threading
 import typing
+import uuid
+import weakref
+import zlib
 # Third party
 import pika
+# Local
+from .localbroker import LocalTransport
+
+
+# the learner may send several queries in one line: BATCH_PREFIX followed by the queries separated by BATCH_SEPARATOR
+# it gets back one line with the responses separated by BATCH_SEPARATOR, in the same order as the queries
+BATCH_PREFIX = "BATCH:"
+BATCH_SEPARATOR = "|"
+
+
+class LearnerClient:
+    """connection of one learner to QuickSocketServer, with its own line buffer and batch"""
+    def __init__(self, sock: socket.socket, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()
+        # responses of the current batch by position, None when not in a batch
+        self.batch_responses = None
+        self.batch_pending = 0
+        # frames that arrived while a batch was being answered, they wait for it so the responses go out in the order of the frames
+        self.waiting = collections.deque()
+
+    def send(self, msg: str):
+        try:
+            msg = msg + "\n"
+            self.sock.sendall(msg.encode('utf-8'))
+        except:
+            print("SEND ERROR")
 
 
 class QuickSocketServer:
-    def __init__(self, port):
+    def __init__(self, port, clients = 1):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         #self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.s.bind(("localhost", port))
-        self.s.listen(1)
-        (self.client, self.address) = self.s.accept()
+        # several learners (eg parallel equivalence oracle workers) can connect, their queries share one cache and are answered in arrival order
+        self.max_clients = clients
+        self.s.listen(clients)
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.accepted = 0
+        self.accept()
+        if clients > 1:
+            self.s.setblocking(False)
+            self.selector.register(self.s, selectors.EVENT_READ)
         self.stack = []
+        # (client, position in its batch or None, query) received but not handed out yet
+        self.ready = collections.deque()
+        # client and batch position of the last query handed out, send() answers it
+        self.current = (None, None)
+
+    def accept(self):
+        sock, address = self.s.accept()
+        sock.setblocking(True)
+        client = LearnerClient(sock, address)
+        self.clients.append(client)
+        self.accepted += 1
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        if self.accepted > 1:
+            print("Learner %s connected from %s" % (self.accepted, address))
+        if self.accepted >= self.max_clients:
+            try:
+                self.selector.unregister(self.s)
+            except KeyError:
+                pass
+
+    def receive(self, client: LearnerClient):
+        """read what the client sent and queue every complete line, messages are newline terminated so long queries are not cut off and queries sent together are not merged"""
+        try:
+            data = client.sock.recv(65536)
+        except OSError:
+            print("LISTEN ERROR")
+            data = b""
+        if not data:
+            self.selector.unregister(client.sock)
+            self.clients.remove(client)
+            client.sock.close()
+            self.ready = collections.deque(entry for entry in self.ready if entry[0] is not client)
+            return
+        client.buffer += data
+        while True:
+            i = client.buffer.find(b"\n")
+            if i < 0:
+                break
+            msg = client.buffer[:i].strip().decode()
+            del client.buffer[:i + 1]
+            # a blank line is no query, handing out "" would look like every learner disconnected
+            if msg:
+                self.frame(client, msg)
+
+    def frame(self, client: LearnerClient, msg: str):
+        """queue the queries of one line from the client, or hold it back until the batch the client is waiting for is answered"""
+        if client.batch_responses is not None:
+            client.waiting.append(msg)
+            return
+        if msg.startswith(BATCH_PREFIX):
+            queries = msg[len(BATCH_PREFIX):].split(BATCH_SEPARATOR)
+            # empty queries are answered right away with an empty response, an empty batch with an empty line
+            client.batch_responses = ["" if not query else None for query in queries]
+            client.batch_pending = len(queries) - queries.count("")
+            if not client.batch_pending:
+                self.send_batch(client)
+                return
+            # run the longest queries first, shorter ones are often their prefixes and then come from the cache
+            for position, query in sorted(enumerate(queries), key=lambda query: -query[1].count(";")):
+                if query:
+                    self.ready.append((client, position, query))
+        else:
+            self.ready.append((client, None, msg))
+
+    def send_batch(self, client: LearnerClient):
+        """answer the batch of the client, then queue what it sent meanwhile"""
+        msg = BATCH_SEPARATOR.join(client.batch_responses)
+        client.batch_responses = None
+        client.send(msg)
+        while client.waiting and client.batch_responses is None:
+            self.frame(client, client.waiting.popleft())
 
     def push(self, msg):
         self.stack.append(msg)
 
-    def listen(self) -> str:
+    def listen(self, timeout: float = None) -> str:
+        """next query from any learner, "" once they have all disconnected, None if there is none within timeout"""
         if self.stack:
             return self.stack.pop()
-        try:
-            msg = self.client.recv(1024).strip()
-            if type(msg) == bytes:
-                msg = msg.decode()
-            return msg
-        except:
-            print("LISTEN ERROR")
-
-    def send(self, msg):
-        try:
-            msg = msg + "\n"
-            self.client.sendall(msg.encode('utf-8'))
-        except:
-            print("SEND ERROR")
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while not self.ready:
+            if not self.clients and self.accepted >= self.max_clients:
+                # every learner connected and disconnected again
+                return ""
+            for key, events in self.selector.select(None if timeout is None else max(0, deadline - time.monotonic())):
+                if key.data is None:
+                    self.accept()
+                else:
+                    self.receive(key.data)
+            if timeout is not None and not self.ready and time.monotonic() >= deadline:
+                return None
+        client, position, query = self.ready.popleft()
+        self.current = (client, position)
+        return query
+
+    def send(self, msg, client: LearnerClient = None, position: int = None):
+        if client is None:
+            client, position = self.current
+        if client not in self.clients:
+            # learner disconnected before its answer was ready
+            return
+        if position is not None:
+            client.batch_responses[position] = msg
+            client.batch_pending -= 1
+            if not client.batch_pending:
+                self.send_batch(client)
+            return
+        client.send(msg)
 
     def close(self):
-        self.client.close()
+        for client in self.clients:
+            client.sock.close()
+        self.selector.close()
         self.s.close()
 
 
@@ -47,6 +186,7 @@ class QuickSocketClient:
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         #self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.s.connect(("localhost", port))
+        self.reader = self.s.makefile("rb")
         self.stack = []
 
     def push(self, msg):
@@ -55,7 +195,7 @@ class QuickSocketClient:
     def listen(self) -> str:
         if self.stack:
             return self.stack.pop()
-        msg = self.s.recv(1024).strip()
+        msg = self.reader.readline().strip()
         if type(msg) == bytes:
             msg = msg.decode()
         return msg
@@ -64,7 +204,13 @@ class QuickSocketClient:
         msg = msg + "\n"
         self.s.sendall(msg.encode('utf-8'))
 
+    def send_batch(self, queries: list) -> list:
+        """send queries in one batch frame and return their responses"""
+        self.send(BATCH_PREFIX + BATCH_SEPARATOR.join(queries))
+        return self.listen().split(BATCH_SEPARATOR)
+
     def close(self):
+        self.reader.close()
         self.s.close()
 
 
@@ -76,14 +222,14 @@ class FakeSocketClient:
             self.data = list(reader)
             self.i = 0
 
-    def listen(self) -> str:
+    def listen(self, timeout: float = None) -> str:
         if self.i < len(self.data):
             if len(self.data[self.i]) >= 1:
                 query = self.data[self.i][0]
                 self.i += 1
                 if query:
                     return query
-        return None
+        return ""
 
     def send(self, msg):
         pass
@@ -107,10 +253,169 @@ class QuickSocketSimulator:
         print("test socket closed (this does nothing!)")
 
 
+class PikaTransport:
+    """rabbitmq transport, keeps one connection and channel open per thread and reconnects when it drops"""
+    def __init__(self, remote_credentials: dict = None, heartbeat: int = 60, prefetch: int = 1):
+        # the mitmproxy addon calls into the same instance from several threads and pika connections are not thread safe
+        self.local = threading.local()
+        self.prefetch = prefetch
+        # extra queue_declare arguments, shared by all threads so every connection declares a queue the same way
+        self.queue_options = {}
+        if remote_credentials is None or "host" not in remote_credentials:
+            self.pika_parameters = pika.ConnectionParameters(host='localhost', heartbeat=heartbeat)
+        else:
+            credentials = pika.PlainCredentials(remote_credentials["user"], remote_credentials["pass"])
+            self.pika_parameters = pika.ConnectionParameters(remote_credentials["host"], remote_credentials["port"], '/', credentials, heartbeat=heartbeat)
+
+    def connect(self) -> pika.adapters.blocking_connection.BlockingChannel:
+        """return the channel for this thread, opening a new connection if there is none or it was closed"""
+        channel = getattr(self.local, "channel", None)
+        if channel is not None and channel.is_open and self.local.connection.is_open:
+            return channel
+        self.close()
+        self.local.connection = pika.BlockingConnection(self.pika_parameters)
+        self.local.channel = self.local.connection.channel()
+        # with manual acks the broker holds back everything past the prefetch window, so nothing is lost if we stop consuming
+        self.local.channel.basic_qos(prefetch_count=self.prefetch)
+        self.local.declared = set()
+        return self.local.channel
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        self.local.connection = None
+        self.local.channel = None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+    def declare(self, channel, queue: str):
+        if queue not in self.local.declared:
+            channel.queue_declare(queue=queue, **self.queue_options.get(queue, {}))
+            self.local.declared.add(queue)
+
+    def private(self, queue: str, expires: int = 24 * 60 * 60 * 1000):
+        """declare queue as a reply queue for one caller, the broker deletes it once nobody has used it for expires ms
+        it's declared right away since replies are published without declaring, a reply arriving before the first consume would be dropped otherwise"""
+        self.queue_options[queue] = {"arguments": {"x-expires": expires}}
+        self.retry(lambda channel: self.declare(channel, queue))
+
+    def retry(self, fn: typing.Callable):
+        """run fn(channel), reconnecting once if the connection or channel was lost (eg missed heartbeats while the SUT was running)"""
+        try:
+            return fn(self.connect())
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError, pika.exceptions.StreamLostError):
+            self.close()
+            return fn(self.connect())
+
+    def publish(self, queue: str, body: bytes, declare: bool = True):
+        def basic_publish(channel):
+            # replies go to a queue the caller declared, publishing to it after it expired just drops the message
+            if declare:
+                self.declare(channel, queue)
+            channel.basic_publish(exchange='', routing_key=queue, body=body)
+        self.retry(basic_publish)
+
+    def get(self, queue: str) -> bytes:
+        def basic_get(channel):
+            self.declare(channel, queue)
+            method_frame, header_frame, body = channel.basic_get(queue)
+            if method_frame:
+                channel.basic_ack(method_frame.delivery_tag)
+                return body
+            return None
+        return self.retry(basic_get)
+
+    def consume(self, queue: str, timeout: float = None) -> bytes:
+        def consume(channel):
+            self.declare(channel, queue)
+            body = None
+            # https://pika.readthedocs.io/en/stable/examples/blocking_consumer_generator.html
+            for method_frame, properties, body in channel.consume(queue=queue, inactivity_timeout=timeout):
+                if body is not None:
+                    channel.basic_ack(method_frame.delivery_tag)
+                break
+            # cancel the consumer, anything delivered but not acked is requeued by the broker
+            channel.cancel()
+            return body
+        return self.retry(consume)
+
+    def length(self, queue: str) -> int:
+        return self.retry(lambda channel: channel.queue_declare(queue, **self.queue_options.get(queue, {}))).method.message_count
+
+    def purge(self, queue: str) -> int:
+        def queue_purge(channel):
+            self.declare(channel, queue)
+            return channel.queue_purge(queue).method.message_count
+        return self.retry(queue_purge)
+
+
+def select_transport(remote_credentials: dict = None):
+    """pick the transport for a config entry, {"transport": "local", "path": ...} or {"transport": "local", "host": ..., "port": ...} selects the built-in broker, anything else uses rabbitmq"""
+    if type(remote_credentials) == dict and remote_credentials.get("transport", "rabbitmq") == "local":
+        return LocalTransport(remote_credentials)
+    if type(remote_credentials) != dict:
+        remote_credentials = None
+    return PikaTransport(remote_credentials)
+
+
+# every message starts with this header: magic, version, flags, session epoch, correlation id, length of the reply queue name
+# followed by the reply queue name (empty if no reply is expected) and the payload
+# version 1: text payloads only, version 2: adds FLAG_PICKLE for binary python objects (eg mitmproxy messages with raw bodies)
+# version 3: adds the correlation id and reply queue for request/reply, and FLAG_ZLIB/FLAG_LZMA for compressed payloads
+ENVELOPE = struct.Struct("!2sBBQQH")
+ENVELOPE_V2 = struct.Struct("!2sBBQ")
+ENVELOPE_MAGIC = b"SB"
+ENVELOPE_VERSION = 3
+FLAG_PICKLE = 1
+FLAG_ZLIB = 2
+FLAG_LZMA = 4
+
+# method: (flag, compress(data, level), decompress(data))
+COMPRESSORS = {
+    "zlib": (FLAG_ZLIB, lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "lzma": (FLAG_LZMA, lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+}
+DECOMPRESSORS = {flag: decompress for flag, compress, decompress in COMPRESSORS.values()}
+# payloads above the threshold (bytes) are compressed, eg GETTRACE replies with megabytes of uflow output
+# override with "compression": {"method": "lzma", "level": 6, "threshold": 65536} in the broker/remote_credentials entry, or "compression": None to disable
+DEFAULT_COMPRESSION = {"method": "zlib", "level": 1, "threshold": 32768}
+
+# number of events each Bugs keeps in its journal, override with "journal_size" in the broker/remote_credentials entry
+JOURNAL_SIZE = 4096
+# every live Bugs, so SIGUSR1 can dump all journals of a process
+journals = weakref.WeakSet()
+
+
+def dump_journals(signum = None, frame = None):
+    """write the journal of every Bugs in this process to logs/, installed as the SIGUSR1 handler"""
+    for bugs in list(journals):
+        try:
+            bugs.writeLog(True)
+        except OSError as e:
+            print("Could not write journal for %s: %s" % (bugs.recvq, e))
+
+
+def unpack(body: bytes) -> tuple:
+    """return (flags, epoch, correlation id, reply queue, payload offset) of an enveloped message, None if there is no envelope"""
+    if type(body) != bytes or body[:len(ENVELOPE_MAGIC)] != ENVELOPE_MAGIC:
+        return None
+    if body[2] < 3:
+        magic, version, flags, epoch = ENVELOPE_V2.unpack_from(body)
+        return flags, epoch, 0, "", ENVELOPE_V2.size
+    magic, version, flags, epoch, corr_id, reply_len = ENVELOPE.unpack_from(body)
+    offset = ENVELOPE.size + reply_len
+    return flags, epoch, corr_id, body[ENVELOPE.size:offset].decode(), offset
+
+
 #new rabbit client, possibly call main program Fudd, because it hunts for bugs, fuzzing/finding unknown deployment ??? debugging??? (this can be the name of the class that reads the state machine to find bugs)
 class Bugs:
-    """wrapper for pika to easily connect with rabbitmq"""
+    """wrapper around a broker transport (rabbitmq via pika, or the built-in local broker) to easily pass messages between slime components"""
     def __init__(self, queue: str, server: bool, remote_credentials: dict = None):
+        # queues of replicated environments are prefixed with their namespace, eg r1-mitm
+        if type(remote_credentials) == dict and "namespace" in remote_credentials:
+            queue = remote_credentials["namespace"] + queue
         # s-queue: mail that goes to server
         # c-queue: mail that goes to client
         if server:
@@ -121,156 +426,306 @@ class Bugs:
             self.recvq = "c-" + queue
         self.lastmsg = ""
         self.qresmsg = ""
-        self.log = []
-        if remote_credentials is None or type(remote_credentials) != dict:
-            self.pika_parameters = pika.ConnectionParameters(host='localhost')
-        else:
-            credentials = pika.PlainCredentials(remote_credentials["user"], remote_credentials["pass"])
-            self.pika_parameters = pika.ConnectionParameters(remote_credentials["host"], remote_credentials["port"], '/', credentials)
+        # journal of broker events as a preallocated ring buffer of (label, queue, bytes, perf_counter_ns), the oldest entries are overwritten
+        self.journal_size = JOURNAL_SIZE
+        if type(remote_credentials) == dict and "journal_size" in remote_credentials:
+            self.journal_size = remote_credentials["journal_size"]
+        self.log = [None] * self.journal_size
+        self.log_seq = itertools.count()
+        self.log_last = -1
+        # perf_counter_ns is only good for differences, this turns it into wall clock time when the journal is written
+        self.log_clock_offset = time.time_ns() - time.perf_counter_ns()
+        journals.add(self)
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGUSR1") and signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL:
+            signal.signal(signal.SIGUSR1, dump_journals)
+        self.transport = select_transport(remote_credentials)
+        # session epoch stamped on every message, the side that calls new_epoch() discards replies from older epochs and the other side follows along
+        self.epoch = 0
+        self.epoch_leader = False
+        self.stale_count = 0
+        # request/reply: every calling thread gets its own reply queue, replies are matched to calls by correlation id
+        self.corr_ids = itertools.count(1)
+        self.callers = threading.local()
+        self.last_corr_id = 0
+        self.last_reply_to = ""
+        # compression is picked per message by the sender and flagged in the envelope, the receiver decompresses whatever it gets
+        self.compression = DEFAULT_COMPRESSION
+        if type(remote_credentials) == dict and "compression" in remote_credentials:
+            self.compression = remote_credentials["compression"] and dict(DEFAULT_COMPRESSION, **remote_credentials["compression"])
+        assert not self.compression or self.compression["method"] in COMPRESSORS, "Invalid compression method: %s" % self.compression["method"]
+        # messages, payload bytes before and after compression, seconds spent
+        self.compression_stats = {
+            "sent": [0, 0, 0, 0.0],
+            "received": [0, 0, 0, 0.0]
+        }
+
+    def close(self):
+        self.transport.close()
 
     def initQueues(self):
-        self.logAppend("init-queues", "start")
         self.send("")
         self.sendq, self.recvq = self.recvq, self.sendq
         self.send("")
         self.sendq, self.recvq = self.recvq, self.sendq
         self.clear()
-        self.logAppend("init-queues", "end")
-
-    def logAppend(self, entryLabel, entryString):
-        # self.log.append([entryLabel, entryString, time.time()])
-        # todo: use https://docs.python.org/3/howto/logging-cookbook.html
-        pass
-
-    def encode(self, msg):
-        # messages need to be encoded as bytes and terminate with a \n
-        msg = str(msg) + "\n"
-        return msg.encode('utf-8')
+        self.logAppend("init-queues", self.recvq, 0)
+
+    def logAppend(self, entryLabel: str, queue: str, size: int):
+        # on the path of every message, so nothing is formatted here and the ring buffer never grows
+        i = self.log_last = next(self.log_seq)
+        self.log[i % self.journal_size] = (entryLabel, queue, size, time.perf_counter_ns())
+
+    def new_epoch(self) -> int:
+        """start a new session, any message still queued from an older session is discarded when received instead of having to drain the queues"""
+        # based on the clock so a restarted slime never reuses an epoch from a previous run
+        self.epoch = max(self.epoch + 1, time.time_ns() // 1000)
+        self.epoch_leader = True
+        return self.epoch
+
+    def encode(self, msg, corr_id: int = 0, reply_to: str = ""):
+        reply_to = reply_to.encode()
+        if not isinstance(msg, (str, int, float)):
+            # dicts etc. are sent as binary pickles so bytes inside them are carried as is
+            flags = FLAG_PICKLE
+            payload = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        else:
+            # messages need to be encoded as bytes and terminate with a \n
+            flags = 0
+            payload = (str(msg) + "\n").encode('utf-8')
+        if self.compression and len(payload) > self.compression["threshold"]:
+            start = time.perf_counter()
+            flag, compress, decompress = COMPRESSORS[self.compression["method"]]
+            compressed = compress(payload, self.compression["level"])
+            stats = self.compression_stats["sent"]
+            stats[0] += 1
+            stats[1] += len(payload)
+            stats[3] += time.perf_counter() - start
+            # incompressible payloads (eg encrypted bodies) are sent as they are
+            if len(compressed) < len(payload):
+                flags |= flag
+                payload = compressed
+            stats[2] += len(payload)
+        return ENVELOPE.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, flags, self.epoch, corr_id, len(reply_to)) + reply_to + payload
 
     def decode(self, msg):
+        header = unpack(msg)
+        if header is not None:
+            flags, offset = header[0], header[4]
+            if flags & (FLAG_ZLIB | FLAG_LZMA):
+                start = time.perf_counter()
+                stats = self.compression_stats["received"]
+                stats[2] += len(msg) - offset
+                msg = DECOMPRESSORS[flags & (FLAG_ZLIB | FLAG_LZMA)](memoryview(msg)[offset:])
+                stats[0] += 1
+                stats[1] += len(msg)
+                stats[3] += time.perf_counter() - start
+                offset = 0
+            if flags & FLAG_PICKLE:
+                return pickle.loads(memoryview(msg)[offset:])
+            msg = msg[offset:]
         msg = msg.strip() # remove \n from encoding, may remove extra whitespace too but this is fine
         if type(msg) == bytes:
             msg = msg.decode()
         return msg
 
-    def callback(self, ch, method, properties, body):
-        ch.stop_consuming()
-        self.lastmsg = self.decode(body)
+    def remember(self, body: bytes):
+        """keep the reply queue and correlation id of a received request for reply()"""
+        header = unpack(body)
+        if header is None:
+            self.last_corr_id, self.last_reply_to = 0, ""
+        else:
+            self.last_corr_id, self.last_reply_to = header[2], header[3]
+
+    def is_stale(self, body: bytes) -> bool:
+        """check the epoch of a received message, following the sender's epoch unless this side leads"""
+        header = unpack(body)
+        if header is None:
+            # message without an envelope, nothing to check
+            return False
+        epoch = header[1]
+        if self.epoch_leader:
+            if epoch < self.epoch:
+                self.stale_count += 1
+                self.logAppend("stale", self.recvq, len(body))
+                return True
+        else:
+            self.epoch = epoch
+        return False
 
     def listen(self, timeout:float = None) -> str:
-        connection = pika.BlockingConnection(self.pika_parameters)
-        channel = connection.channel()
-        channel.queue_declare(queue=self.recvq)
-        if timeout == None:
-            channel.basic_consume(on_message_callback = self.callback, queue=self.recvq, auto_ack = True)
-            channel.start_consuming()
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            body = self.transport.consume(self.recvq, timeout)
+            if body is None or not self.is_stale(body):
+                break
+            if timeout is not None:
+                timeout = max(0, deadline - time.monotonic())
+        self.remember(body)
+        if body is None:
+            self.logAppend("timeout", self.recvq, 0)
+            self.lastmsg = "TIMEOUT"
         else:
-            # https://pika.readthedocs.io/en/stable/examples/blocking_consumer_generator.html
-            for method_frame, properties, body in channel.consume(queue=self.recvq, auto_ack = True, inactivity_timeout=timeout):
-                if body == None:
-                    self.lastmsg = "TIMEOUT"
-                    break
-                else:
-                    self.lastmsg = self.decode(body)
-                    # channel.basic_ack(method_frame.delivery_tag)
-                    break
-        # Cancel the consumer and return any pending messages
-        # requeued_messages = channel.cancel()
-        # channel.close()
-        connection.close()
-        self.logAppend("listen", str(self.lastmsg))
+            self.logAppend("listen", self.recvq, len(body))
+            self.lastmsg = self.decode(body)
         return self.lastmsg
 
     def get(self):
-        connection = pika.BlockingConnection(self.pika_parameters)
-        channel = connection.channel()
-        method_frame, header_frame, body = channel.basic_get(self.recvq)
-        if method_frame:
-                #print(method_frame, header_frame, body)
-                channel.basic_ack(method_frame.delivery_tag)
-                connection.close()
-                self.lastmsg = self.decode(body)
-                self.logAppend("get", str(self.lastmsg))
-                return self.lastmsg
-        else:
-                connection.close()
-                return None
+        body = self.transport.get(self.recvq)
+        while body is not None and self.is_stale(body):
+            body = self.transport.get(self.recvq)
+        if body is None:
+            return None
+        self.logAppend("get", self.recvq, len(body))
+        self.remember(body)
+        self.lastmsg = self.decode(body)
+        return self.lastmsg
 
     def send(self, msg):
-        self.logAppend("send", str(msg))
-        connection = pika.BlockingConnection(self.pika_parameters)
-        channel = connection.channel()
+        body = self.encode(msg)
+        self.logAppend("send", self.sendq, len(body))
+        self.transport.publish(self.sendq, body)
+
+    def caller(self):
+        """reply queue and outstanding calls of the calling thread"""
+        if getattr(self.callers, "reply_to", None) is None:
+            self.callers.reply_to = "r-" + self.recvq + "-" + uuid.uuid4().hex[:12]
+            self.callers.pending = set()
+            self.callers.replies = {}
+            self.transport.private(self.callers.reply_to)
+        return self.callers
+
+    def call(self, msg) -> int:
+        """send a request without waiting, returns the correlation id to pass to wait(), several calls can be in flight at once"""
+        caller = self.caller()
+        corr_id = next(self.corr_ids)
+        caller.pending.add(corr_id)
+        body = self.encode(msg, corr_id, caller.reply_to)
+        self.logAppend("call", self.sendq, len(body))
+        self.transport.publish(self.sendq, body)
+        return corr_id
+
+    def wait(self, corr_id: int, timeout: float = None):
+        """wait for the reply to call(), replies to other calls of this thread are kept until they are waited for"""
+        caller = self.caller()
+        if corr_id in caller.replies:
+            caller.pending.discard(corr_id)
+            self.lastmsg = caller.replies.pop(corr_id)
+            return self.lastmsg
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            body = self.transport.consume(caller.reply_to, timeout)
+            if body is None:
+                # a late reply is dropped when it arrives since its id is no longer pending
+                caller.pending.discard(corr_id)
+                self.logAppend("timeout", caller.reply_to, 0)
+                self.lastmsg = "TIMEOUT"
+                break
+            if not self.is_stale(body):
+                reply_id = (unpack(body) or (0,) * 3)[2]
+                self.logAppend("wait", caller.reply_to, len(body))
+                if reply_id == corr_id:
+                    caller.pending.discard(corr_id)
+                    self.lastmsg = self.decode(body)
+                    break
+                if reply_id in caller.pending:
+                    caller.replies[reply_id] = self.decode(body)
+            if timeout is not None:
+                timeout = max(0, deadline - time.monotonic())
+        return self.lastmsg
 
-        channel.queue_declare(queue=self.sendq)
+    def request(self, msg, timeout: float = None):
+        """send msg and wait for the reply to it, returns "TIMEOUT" if there is none in time"""
+        return self.wait(self.call(msg), timeout)
 
-        channel.basic_publish(exchange='',
-            routing_key=self.sendq,
-            body=self.encode(msg))
-        connection.close()
+    def reply(self, msg, reply_to: str = None, corr_id: int = None):
+        """answer the last received message (or the given reply queue and id), plain send if the sender did not ask for a reply"""
+        if reply_to is None:
+            reply_to, corr_id = self.last_reply_to, self.last_corr_id
+        if not reply_to:
+            return self.send(msg)
+        body = self.encode(msg, corr_id)
+        self.logAppend("reply", reply_to, len(body))
+        self.transport.publish(reply_to, body, declare=False)
 
     def requeue(self, msg):
-        self.logAppend("requeue", str(msg))
-        connection = pika.BlockingConnection(self.pika_parameters)
-        channel = connection.channel()
-
-        channel.queue_declare(queue=self.recvq)
-
-        channel.basic_publish(exchange='',
-            routing_key=self.recvq,
-            body=self.encode(msg))
-        connection.close()
+        body = self.encode(msg)
+        self.logAppend("requeue", self.recvq, len(body))
+        self.transport.publish(self.recvq, body)
 
     def getlastmsg(self):
         return self.lastmsg
 
     def qlen(self, recv = True):
-        connection = pika.BlockingConnection(self.pika_parameters)
-        channel = connection.channel()
         if recv:
-            q = channel.queue_declare(self.recvq)
-        else:
-            q = channel.queue_declare(self.sendq)
-        q_len = q.method.message_count
-        connection.close()
-        return q_len
+            return self.transport.length(self.recvq)
+        return self.transport.length(self.sendq)
 
-    def clear(self, sendq = True, recvq = True):
+    def clear(self, sendq = True, recvq = True) -> int:
+        """purge the queues on the broker, one round trip each regardless of how many messages are waiting, returns the number of messages purged"""
+        count = 0
         if sendq:
-            self.logAppend("clear-sendq", "start")
-            self.sendq, self.recvq = self.recvq, self.sendq
-        tmp = self.get()
-        self.logAppend("clear", str(tmp))
-        while (tmp != None):
-            tmp = self.get()
-            self.logAppend("clear", str(tmp))
-        tmp = self.get()
-        self.logAppend("clear", str(tmp))
-        if sendq:
-            self.sendq, self.recvq = self.recvq, self.sendq
-            self.logAppend("clear-sendq", "end")
+            purged = self.transport.purge(self.sendq)
+            self.logAppend("clear", self.sendq, purged)
+            count += purged
         if recvq:
-            self.logAppend("clear-recvq", "start")
-            tmp = self.get()
-            self.logAppend("clear", str(tmp))
-            while (tmp != None):
-                tmp = self.get()
-                self.logAppend("clear", str(tmp))
-            tmp = self.get()
-            self.logAppend("clear", str(tmp))
-            self.logAppend("clear-recvq", "end")
-
-    def getLog(self):
-        return self.log
-
-    def writeLog(self, time = False):
-        log = self.log
-        if time:
-            j = 3
-        else:
-            j = 2
+            purged = self.transport.purge(self.recvq)
+            self.logAppend("clear", self.recvq, purged)
+            count += purged
+        return count
+
+    def compression_report(self) -> str:
+        """one line per direction with the number of compressed messages, the ratio and time spent, empty if nothing was compressed"""
+        report = []
+        for direction, (count, raw, wire, seconds) in self.compression_stats.items():
+            if count:
+                report.append("%s %s: %s compressed messages, %s -> %s bytes (ratio %.1f), %.3fs" % (self.recvq, direction, count, raw, wire, raw / max(wire, 1), seconds))
+        return "\n".join(report)
+
+    def getLog(self) -> list:
+        """journal entries oldest first, (label, queue, bytes, perf_counter_ns)"""
+        count = self.log_last + 1
+        if count <= self.journal_size:
+            return self.log[:count]
+        start = count % self.journal_size
+        return self.log[start:] + self.log[:start]
+
+    def writeLog(self, time = False, binary = False):
+        """write the journal to logs/<recvq>-log.csv (label, queue, bytes and the wall clock time if time is set), or as a pickle to logs/<recvq>-log.bin"""
+        log = self.getLog()
+        if binary:
+            with open("logs/" + self.recvq + "-log.bin", "wb") as f:
+                pickle.dump({"clock_offset": self.log_clock_offset, "dropped": self.log_last + 1 - len(log), "log": log}, f, pickle.HIGHEST_PROTOCOL)
+            return
         with open("logs/" + self.recvq + "-log.csv", "w", newline='') as f:
             writer = csv.writer(f)
-            for i in range(len(log)):
-                entry = log[i][:j]
-                writer.writerow(entry)
+            for entryLabel, queue, size, timestamp in log:
+                if time:
+                    writer.writerow([entryLabel, queue, size, "%.6f" % ((timestamp + self.log_clock_offset) / 1e9)])
+                else:
+                    writer.writerow([entryLabel, queue, size])
+
+
+class AsyncBugs:
+    """asyncio front end for Bugs, blocking calls run on a worker thread per instance (with its own connection) so commands to different controllers overlap"""
+    def __init__(self, bugs: Bugs):
+        self.bugs = bugs
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=bugs.recvq)
 
+    async def run(self, fn: typing.Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def send(self, msg):
+        await self.run(self.bugs.send, msg)
+
+    async def listen(self, timeout: float = None):
+        return await self.run(self.bugs.listen, timeout)
+
+    async def request(self, msg, timeout: float = None):
+        """send msg and wait for the reply to it"""
+        return await self.run(self.bugs.request, msg, timeout)
+
+    def close(self):
+        self.executor.submit(self.bugs.close)
+        self.executor.shutdown()
@@ -1,16 +1,23 @@
+import collections
 import copy
+import hashlib
+import json
 import pickle
 import re
 import sys
+import threading
 import typing
 from .utils import loguru_decorator, for_all_methods
 
 
 @for_all_methods(loguru_decorator)
 class MessageFuzzerData:
-    def __init__(self) -> None:
+    def __init__(self, plaid_mode: str = "symbolic") -> None:
         self.session_history = []
         self.plaid_msg = []
+        # "symbolic": plaid messages are what the fuzzer makes of the command, "content": a fingerprint of what is actually passed on by the mitm, so eg replaying a message and sending an identical one are equivalent
+        self.plaid_mode = plaid_mode
+        self.plaid_content = []
         # self.full_history = []  # WARNING: This is lost on resuming from a previous log
 
     def store_history(self, msg_out: dict, symbol: str, cmd: str):
@@ -25,27 +32,78 @@ class MessageFuzzerData:
             "msg_mod": None
         })
 
+    def store_delivered(self, return_code: int, action: str, message: str, cookies: list):
+        """content plaid mode, fingerprint of the last message as the mitm passes it on (or not)
+        the return code is part of it, eg an inapplicable replay passes the message on like allow but its output is term or 1-..."""
+        last = self.session_history[-1]
+        fingerprint = json.dumps([last["mitm_name"], last["type"], return_code, action, message, cookies])
+        self.plaid_content.append(hashlib.blake2b(fingerprint.encode(), digest_size=8).hexdigest())
+
     def get_plaid_msg(self) -> str:
         """returns an 'equivalent message string' to see if queries are effectively equivalent without knowing the state machine"""
+        if self.plaid_mode == "content":
+            return "###".join(self.plaid_content)
         return "###".join(self.plaid_msg)
 
-    def new_session(self):
+    def new_session(self, resume: tuple = None):
+        """log the last session and start a new one, or one that continues from a session() of a live session"""
         pickle.dump(self.session_history, self.pickle_file)
         self.pickle_file.flush()
         # self.full_history.append(copy.copy(self.session_history)) # deprecate, (could be nondeterminstic since a newer session could have different results at different times for the same query)
         self.session_history.clear()
         self.plaid_msg.clear()
+        self.plaid_content.clear()
+        if resume is not None:
+            # replays refer to messages by their index in the session and plaid messages cover the whole query, so the prefix is carried over
+            session_history, plaid_msg, plaid_content = resume
+            self.session_history.extend(session_history)
+            self.plaid_msg.extend(plaid_msg)
+            self.plaid_content.extend(plaid_content)
+
+    def session(self) -> tuple:
+        """copy of the session so far, for new_session() to continue from"""
+        return list(self.session_history), list(self.plaid_msg), list(self.plaid_content)
 
-    def open_log(self, resume: bool = False):
+    def open_log(self, resume: bool = False, fname: str = "logs/fuzzer.pickle"):
         if resume:
-            self.pickle_file = open("logs/fuzzer.pickle", "ab")
+            self.pickle_file = open(fname, "ab")
         else:
-            self.pickle_file = open("logs/fuzzer.pickle", "wb")
+            self.pickle_file = open(fname, "wb")
 
     def close_log(self):
         self.new_session()
         self.pickle_file.close()
 
+class SessionHistoryMarks:
+    """session history and outputs at the start of each action run on the SUTs, keyed by the query prefix before it, least recently used ones are dropped
+    lets the fuzzer dry run the next action of a new query on the history of its prefix instead of running the SUTs
+    only the fields the fuzzer decides on are kept, a dry run is only used if the message would be passed on unchanged so its content never matters"""
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self.marks = collections.OrderedDict()
+        self.lock = threading.Lock()  # replicas mark from their own threads
+
+    def mark(self, prefix: str, session_history: list, output_symbols: list):
+        with self.lock:
+            old = self.marks.pop(prefix, None)
+            # [session history, outputs of the prefix, whether a message came back after passing on the last one unchanged (None if not known yet)]
+            self.marks[prefix] = [[{"cmd": entry["cmd"], "message": "", "cookies": [], "type": entry["type"], "symbol": entry["symbol"], "mitm_name": entry["mitm_name"], "msg_mod": None} for entry in session_history], list(output_symbols), old[2] if old else None]
+            if len(self.marks) > self.size:
+                self.marks.popitem(last=False)
+
+    def forwarded(self, prefix: str, arrived: bool):
+        with self.lock:
+            if prefix in self.marks:
+                self.marks[prefix][2] = arrived
+
+    def get(self, prefix: str) -> list:
+        with self.lock:
+            mark = self.marks.get(prefix)
+            if mark is not None:
+                self.marks.move_to_end(prefix)
+            return mark
+
+
 @for_all_methods(loguru_decorator)
 class MessageFuzzer:
     """base class"""
@@ -75,6 +133,11 @@ class MessageFuzzer:
 
     def fuzz(self, cmd) -> tuple[int, str, dict]:
         output_return_code, replace_flag, new_cmd, extras = self.fuzzer(cmd)
+        if self.data.plaid_mode == "content":
+            if replace_flag:
+                self.data.store_delivered(output_return_code, "replace", new_cmd, extras.get("cookies", self.session_history[-1]["cookies"]))
+            else:
+                self.data.store_delivered(output_return_code, cmd if new_cmd is None else new_cmd, self.session_history[-1]["message"], self.session_history[-1]["cookies"])
         if new_cmd is None:
             # same command, no changes
             return output_return_code, cmd, extras
@@ -5,6 +5,7 @@ import os
 import json
 import pickle
 import sys
+import threading
 import typing
 # Local
 from .utils import readJson, writeCsv, writeJson
@@ -16,6 +17,10 @@ class MessageParserData:
         self.output_alphabet_symbols = {}
         self.output_alphabet_examples = {}
         self.parser_errors = []
+        # counts changes to the output alphabet (new symbols and request/response flags of their examples), so copies of it are only written when it changed
+        self.version = 0
+        # shared by the mitm managers of all replicas so they number the output symbols the same way
+        self.lock = threading.RLock()
 
     def readSymbols(self):
         assert os.path.isfile("logs/output_alphabet.json")
@@ -51,15 +56,18 @@ class MessageParser:
         self.parser_errors = data.parser_errors
 
     def lookupSymbol(self, key: str, original_message: str = "", message_source: str = "UNKNOWN") -> str:
-        if str(key) not in self.output_alphabet_symbols:
-            self.output_alphabet_symbols[str(key)] = str(len(self.output_alphabet_symbols) + 1)
-            self.output_alphabet_examples[str(len(self.output_alphabet_symbols))] = {"example": str(original_message), "parsed": str(key), "source": message_source, "request": False, "response": False, "legend": ""}
-            self.data.writeSymbols()
-        return self.output_alphabet_symbols[str(key)]
+        with self.data.lock:
+            if str(key) not in self.output_alphabet_symbols:
+                self.output_alphabet_symbols[str(key)] = str(len(self.output_alphabet_symbols) + 1)
+                self.output_alphabet_examples[str(len(self.output_alphabet_symbols))] = {"example": str(original_message), "parsed": str(key), "source": message_source, "request": False, "response": False, "legend": ""}
+                self.data.version += 1
+                self.data.writeSymbols()
+            return self.output_alphabet_symbols[str(key)]
 
     def logError(self, error):
-        self.parser_errors.append(error)
-        self.data.writeParserErrors()
+        with self.data.lock:
+            self.parser_errors.append(error)
+            self.data.writeParserErrors()
 
     def recursiveDictKeys(self, d:typing.Union[dict, list]) -> list:
         if type(d) in [dict, collections.OrderedDict]:
@@ -81,7 +89,10 @@ class MessageParser:
             else:
                 parsed_message = self.parser(message, message_type)
             output_symbol = self.lookupSymbol(parsed_message, message, message_source)
-            self.output_alphabet_examples[output_symbol][message_type] = True
+            with self.data.lock:
+                if not self.output_alphabet_examples[output_symbol].get(message_type):
+                    self.output_alphabet_examples[output_symbol][message_type] = True
+                    self.data.version += 1
             return output_symbol
         except:
             self.logError(message_type + ":" + message)
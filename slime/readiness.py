@@ -0,0 +1,133 @@
+# Standard library
+import os
+import re
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import typing
+# Third party
+import psutil
+# Local
+from .utils import wait_until
+
+
+# probes return something true once the SUT is ready, they are polled with exponential backoff by wait_ready
+# select_probe builds one from a ready_probe entry in the controller_options, eg {"type": "tcp", "port": 8080}
+
+TCP_LISTEN = "0A"
+
+
+def tcp_probe(port: int, host: str = "localhost") -> typing.Callable:
+    """ready once a tcp connection to host:port is accepted, the SUT sees this as a client connecting and closing again"""
+    def probe():
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            return False
+    return probe
+
+
+def file_probe(path: str) -> typing.Callable:
+    """ready once path exists and is not empty, eg a ready-file or pid file written by the SUT"""
+    def probe():
+        try:
+            return os.path.getsize(path) > 0
+        except OSError:
+            return False
+    return probe
+
+
+def stdout_probe(stream: typing.IO, pattern: str) -> typing.Callable:
+    """ready once a line matching pattern was printed, the stream is read by a thread that keeps draining it afterwards so the SUT never blocks on a full pipe"""
+    matcher = re.compile(pattern)
+    ready = threading.Event()
+    def reader():
+        for line in iter(stream.readline, ""):
+            if not ready.is_set() and matcher.search(line):
+                ready.set()
+    threading.Thread(target=reader, name="ready-stdout", daemon=True).start()
+    return ready.is_set
+
+
+def cmd_probe(cmd: str) -> typing.Callable:
+    """ready once cmd prints "ready", runs a subprocess every time so it's the most expensive probe"""
+    return lambda: "ready" in subprocess.run(shlex.split(cmd), capture_output=True, universal_newlines=True).stdout
+
+
+def proc_net_sockets(pid: int, kinds: tuple = ("tcp", "tcp6")) -> list:
+    """(local port, state, inode) of the sockets in /proc/<pid>/net, ie only the network namespace of the SUT instead of every socket on the host"""
+    sockets = []
+    for kind in kinds:
+        try:
+            with open("/proc/%s/net/%s" % (pid, kind)) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    sockets.append((int(fields[1].rsplit(":", 1)[1], 16), fields[3], fields[9]))
+        except FileNotFoundError:
+            # no ipv6, or the process is gone
+            pass
+    return sockets
+
+
+def socket_inodes(pid: int) -> set:
+    """inodes of the sockets the process has open"""
+    inodes = set()
+    fd_dir = "/proc/%s/fd" % pid
+    for fd in os.listdir(fd_dir):
+        try:
+            link = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if link.startswith("socket:["):
+            inodes.add(link[8:-1])
+    return inodes
+
+
+def proc_net_probe(proc: psutil.Process, port: int = None) -> typing.Callable:
+    """ready once something in the network namespace of proc listens on port, or if no port is given once proc or one of its children has an inet socket
+    falls back to psutil where /proc can't be read, eg not on linux or the SUT runs as another user"""
+    def probe():
+        try:
+            if port is not None:
+                return any(local_port == port and state == TCP_LISTEN for local_port, state, inode in proc_net_sockets(proc.pid))
+            inodes = set()
+            for p in [proc] + proc.children(recursive=True):
+                inodes |= socket_inodes(p.pid)
+            return bool(inodes) and any(inode in inodes for local_port, state, inode in proc_net_sockets(proc.pid, ("tcp", "tcp6", "udp", "udp6")))
+        except (psutil.NoSuchProcess, FileNotFoundError):
+            # children can exit while they are walked
+            return False
+        except (PermissionError, psutil.AccessDenied):
+            if port is not None:
+                return any(c.laddr.port == port for c in psutil.net_connections() if c.status == "LISTEN")
+            return any(p.connections() for p in proc.children(recursive=True)) or proc.connections()
+    return probe
+
+
+def select_probe(ready_probe: dict, proc: psutil.Process = None, stream: typing.IO = None) -> typing.Callable:
+    """build a probe from a ready_probe config entry, the type is one of tcp, file, stdout, cmd or proc_net"""
+    if ready_probe["type"] == "tcp":
+        return tcp_probe(ready_probe["port"], ready_probe.get("host", "localhost"))
+    elif ready_probe["type"] == "file":
+        return file_probe(ready_probe["path"])
+    elif ready_probe["type"] == "stdout":
+        if stream is None:
+            raise ValueError("stdout ready probe is not supported by this controller")
+        return stdout_probe(stream, ready_probe["pattern"])
+    elif ready_probe["type"] == "cmd":
+        return cmd_probe(ready_probe["cmd"])
+    elif ready_probe["type"] == "proc_net":
+        return proc_net_probe(proc, ready_probe.get("port"))
+    raise ValueError("Invalid ready probe: %s" % ready_probe["type"])
+
+
+def wait_ready(name: str, probe: typing.Callable, timeout: float = None, max_interval: float = 0.1) -> float:
+    """poll probe with backoff until the SUT is ready and return how many seconds that took, raises TimeoutError after timeout seconds"""
+    start = time.perf_counter()
+    if not wait_until(probe, timeout, max_interval=max_interval):
+        raise TimeoutError("%s not ready after %ss" % (name, timeout))
+    return time.perf_counter() - start
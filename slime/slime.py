@@ -8,7 +8,10 @@ import subprocess
 import shlex
 import signal
 import code
+import collections
+import concurrent.futures
 import pdb
+import threading
 import traceback
 import time
 import argparse
@@ -24,18 +27,21 @@ import importlib
 import psutil
 # Local
 from .msgbroker import FakeSocketClient, QuickSocketServer, Bugs
-from .utils import readJson, LearnlibCommandLog, terminator, loguru_decorator
+from .utils import readJson, replica_config, LearnlibCommandLog, QueryStore, Speculator, LatencyModel, QuiescenceDetector, terminator, loguru_decorator
 from .sutctrl import start_sutctrl
 from .sutman import SutManager
 from .mitmproxyctrl import start_mitm
 from .mitmman import MitmManager
+from .msgfuzzer import SessionHistoryMarks
 
 
 
 class SLIME:
     @loguru_decorator
     def __init__(self, args, config_file, starting_dir):
-        self.config = readJson(config_file)
+        # the config is a template for every replica of the SUT/mitm environment, this process runs replica args.replica (0 unless given)
+        self.config_template = readJson(config_file)
+        self.config = replica_config(self.config_template, args.replica)
         self.args = args
         self.learning_session_locals = {}
 
@@ -64,7 +70,7 @@ class SLIME:
             else:
                 sut_name = list(self.config["sut_controllers"].keys())[args.s]
             print("STARTING SUT: " + sut_name)
-            start_sutctrl(self.config["sut_controllers"][sut_name], sut_name, user_module)
+            start_sutctrl(self.config["sut_controllers"][sut_name], sut_name, user_module, self.config["slime_config"].get("broker"))
             sys.exit()      
 
         # init mitm controller
@@ -84,7 +90,7 @@ class SLIME:
                 cmd_start = cmd_start.replace("mitmdump", "mitmweb --web-port " + str(self.config["slime_config"]["mitm_interactive_web_port"] + args.m))
                 self.config["mitm_controllers"][mitm_name]["cmd_start"] = cmd_start
             print("STARTING MITM: " + mitm_name)
-            start_mitm(self.config["mitm_controllers"][mitm_name]) # this runs forever now and need to rerun slime.py in a new terminal
+            start_mitm(self.config["mitm_controllers"][mitm_name], self.config["slime_config"].get("broker")) # this runs forever now and need to rerun slime.py in a new terminal
             if args.i:
                 code.interact(local=locals())
             sys.exit() # don't want to run again and accidentally overwrite anything
@@ -95,9 +101,11 @@ class SLIME:
             self.mitm.clearFlows()
             # todo: add cleanup command to config to reset iptables
             # stop all running containers
-            self.sut = SutManager(self.config["sut_controllers"], user_module)
-            for i in range(self.sut.len()):
-                self.sut.q(i).send("KILL")
+            for replica in range(self.config["slime_config"].get("replicas", 1)):
+                config = replica_config(self.config_template, replica)
+                sut = SutManager(config["sut_controllers"], user_module, config["slime_config"].get("broker"))
+                for i in range(sut.len()):
+                    sut.q(i).send("KILL")
             time.sleep(2)
             self.mitm.clearFlows()
             sys.exit()
@@ -108,13 +116,14 @@ class SLIME:
             sys.exit()
 
         # init logging
-        self.log = LearnlibCommandLog(resume=args.r, ludicrous_speed=self.config["slime_config"]["ludicrous_speed"], plaid=self.config["slime_config"]["plaid"])
+        self.log = LearnlibCommandLog(resume=args.r, ludicrous_speed=self.config["slime_config"]["ludicrous_speed"], plaid=self.config["slime_config"]["plaid"],
+            sink_symbols=self.config["slime_config"].get("sink_symbols"), sink_observations=self.config["slime_config"].get("sink_observations", 0), sink_verify_rate=self.config["slime_config"].get("sink_verify_rate", 0.05))
         self.mitm.fuzzer_data.open_log(resume=args.r)
 
         # setup socket to statelearner
         print("Connecting to statelearner...")
         if args.l or args.r:
-            self.ll = QuickSocketServer(self.config["slime_config"]["statelearner_port"])
+            self.ll = QuickSocketServer(self.config["slime_config"]["statelearner_port"], self.config["slime_config"].get("statelearner_clients", 1))
         elif args.c:
             self.ll = FakeSocketClient()
         else:
@@ -129,70 +138,151 @@ class SLIME:
         # resume previous session
         if args.r:
             self.mitm.parser_data.readSymbols()
-            print("Replaying previous queries")
-            replay_count = 0
-            cache_count = 0
-            while True:
-                # load previous query
-                query, response = self.log.resume_next()
-                if query and response:
-                    new_query = self.ll.listen()
-                    if query == new_query:
-                        # learning session has remained the same so far (this should be the case unless statelearner.properties has been changed)
-                        print ("input query: " + query)
-                        print ("res: " + response)
-                        replay_count += 1
-                        self.log.write_entry(True)
-                        self.ll.send(response)
-                    else:
-                        # resumed as much as possible, put next query into a stack and load remaining entries to cache
-                        print("Caching remaining previous queries")
-                        self.ll.push(new_query)
-                        while query and response:
-                            cache_count += 1
-                            self.log.write_entry(False)
-                            query, response = self.log.resume_next()     
-                else:
-                    break
-            print("Loaded %s queries, of which %s were replayed and %s were only cached" % (replay_count+cache_count, replay_count, cache_count))
+            print("Loading previous queries")
+            start = time.perf_counter()
+            entries = self.log.resume()
+            elapsed = time.perf_counter() - start
+            print("Loaded %s queries in %.2fs (%.0f queries/s), the learner's queries will be answered from the cache" % (entries, elapsed, entries / max(elapsed, 1e-9)))
+
+        # persistent query store, answers everything measured by earlier runs with the same configuration (in any order, unlike resuming)
+        self.query_store = None
+        if self.config["slime_config"].get("query_store"):
+            fname = self.config["slime_config"]["query_store"]
+            if fname is True:
+                fname = "query_store.sqlite"
+            self.query_store = QueryStore(fname, QueryStore.config_fingerprint(replica_config(self.config_template)))
+            symbols, examples = self.query_store.load_alphabet()
+            current_symbols = self.mitm.parser_data.output_alphabet_symbols
+            if current_symbols.items() <= symbols.items():
+                self.mitm.parser_data.output_alphabet_symbols.update(symbols)
+                self.mitm.parser_data.output_alphabet_examples.update(examples)
+            elif not symbols.items() <= current_symbols.items():
+                # stored responses would mean different messages than in this run
+                print("Query store not used, its output alphabet doesn't match the loaded one")
+                self.query_store.close()
+                self.query_store = None
+            if self.query_store:
+                print("Loaded %s queries from the query store" % self.log.preload(self.query_store.load()))
 
         # setup systems under test
         print("Setting up systems under test...")
-        self.sut = SutManager(self.config["sut_controllers"], user_module)
+        self.sut = SutManager(self.config["sut_controllers"], user_module, self.config["slime_config"].get("broker"))
+
+        # replica pool, replica 0 is self.mitm and self.sut, the others are generated from the same config and run sessions in parallel
+        # output symbols are shared so every replica parses messages to the same alphabet, fuzzer logs are per replica
+        self.replicas = [(self.mitm, self.sut)]
+        for replica in range(1, self.config["slime_config"].get("replicas", 1)):
+            print("Setting up replica %s..." % replica)
+            config = replica_config(self.config_template, replica)
+            mitm = MitmManager(config, user_module, self.mitm.parser_data)
+            mitm.fuzzer_data.open_log(resume=args.r, fname="logs/fuzzer-%s.pickle" % replica)
+            self.replicas.append((mitm, SutManager(config["sut_controllers"], user_module, config["slime_config"].get("broker"))))
+
+        # ludicrous speed, a query whose next action isn't applicable after a prefix run before terminates the same way without running the SUTs
+        self.history_marks = None
+        self.dry_run_count = 0
+        if self.config["slime_config"].get("dry_run") and self.config["slime_config"]["ludicrous_speed"]:
+            self.history_marks = SessionHistoryMarks(self.config["slime_config"].get("history_marks", 1000))
+
+        # idle replicas run likely next queries while waiting for the learner
+        self.speculator = None
+        if self.config["slime_config"].get("speculation_budget"):
+            self.speculator = Speculator(self.config["slime_config"]["speculation_budget"], self.config["slime_config"].get("speculation_reserve", 1))
+
+        # lazy teardown, the SUTs of a replica are left running after a session for up to this many seconds so a query extending it can continue it
+        self.lazy_teardown = self.config["slime_config"].get("lazy_teardown", 0) if not self.args.i else 0
+        self.live_sessions = [None] * len(self.replicas)
+        self.continuations = 0
+        # the counters for the end of run reports are updated from the replica threads of the dispatch loop
+        self.stats_lock = threading.Lock()
+        self.mitm_process_ctrls = [None] * len(self.replicas)
+        # number of and seconds spent killing and starting the SUTs, until every controller acknowledged
+        self.restart_times = {
+            "kill": [0, 0.0],
+            "start": [0, 0.0]
+        }
+
+        # listen timeouts from the latencies measured so far, kept across runs in the given file
+        self.latency = None
+        if self.config["slime_config"].get("adaptive_timeouts"):
+            self.latency = LatencyModel(self.config["slime_config"]["adaptive_timeouts"], self.config["slime_config"].get("timeout_quantile", 0.99), self.config["slime_config"].get("timeout_margin", 2.0))
+            for mitm, sut in self.replicas:
+                mitm.latency = self.latency
+
+        # stop listening before the timeout once the SUTs and the mitm queue went quiet, eg "quiescence": {"interval": 0.1, "samples": 3, "min_wait": 0.5}
+        # needs SUT controllers that keep their process in self.proc (the Simple_Kill_* and Simple_Root_* ones)
+        self.quiescence = None
+        if self.config["slime_config"].get("quiescence"):
+            quiescence = self.config["slime_config"]["quiescence"]
+            self.quiescence = QuiescenceDetector(**(quiescence if type(quiescence) == dict else {}))
+            for mitm, sut in self.replicas:
+                mitm.quiescence = self.quiescence
+                mitm.activity = sut.get_activity
 
     @loguru_decorator
-    def killSuts(self):
-        self.mitm.clearFlows() # clean up any flows that are waiting, easier to kill SUTs that aren't hanging in the middle of a flow
-        for i in range(self.sut.len()):
-            self.sut.q(i).send("KILL") # remember where clean slate is, i had a reason to do it before kill, and after killing, don't know where it should be now
-            _ = self.sut.q(i).listen()
-        time.sleep(0.1) # is 2 always enough? more or less???
+    def killSuts(self, replica: int = 0):
+        mitm, sut = self.replicas[replica]
+        start = time.perf_counter()
+        mitm.clearFlows() # clean up any flows that are waiting, easier to kill SUTs that aren't hanging in the middle of a flow
+        sut.kill_all() # returns once every SUT controller acknowledged that its SUT is dead
+        with self.stats_lock:
+            self.restart_times["kill"][0] += 1
+            self.restart_times["kill"][1] += time.perf_counter() - start
 
     @loguru_decorator
-    def startSuts(self):
-        self.mitm.clearQueues() # clear queues before restarting SUTs
-        time.sleep(0.2)
-        for i in range(self.sut.len()):
-            self.sut.q(i).send("START")
-            _ = self.sut.q(i).listen()
-        self.mitm.reset() # starts by listening for the first request
+    def startSuts(self, replica: int = 0, abort: threading.Event = None):
+        """restart the SUTs of a replica and wait for the first message, a speculative session that gets aborted meanwhile skips what is left"""
+        mitm, sut = self.replicas[replica]
+        start = time.perf_counter()
+        # clear queues before restarting SUTs, messages of the last session can still be on their way (flows released by clearFlows, late responses of the dying SUTs)
+        # the mitm queue isn't epoch led, so it's drained until nothing arrived for mitm_settle seconds (0.1 by default), or for at most 10 times that
+        # each flow is answered with clear_flows on the way, mitmproxy would be blocked on it otherwise
+        settle = self.config["slime_config"].get("mitm_settle", 0.1)
+        mitm.drainFlows(settle, settle * 10)
+        if abort is not None and abort.is_set():
+            return
+        sut.new_epoch() # anything still queued from the last session gets discarded on arrival
+        sut.start_all("parallel_sut_start" in self.config["slime_config"] and self.config["slime_config"]["parallel_sut_start"])
+        with self.stats_lock:
+            self.restart_times["start"][0] += 1
+            self.restart_times["start"][1] += time.perf_counter() - start
+        mitm.reset() # starts by listening for the first request
 
     # @pysnooper.snoop('logs/pysnooper.log')
     @loguru_decorator
-    def learningSession(self, input_query: str) -> tuple[str, str]:
+    def learningSession(self, input_query: str, replica: int = 0, abort: threading.Event = None, live: dict = None) -> tuple[str, str, dict]:
+        mitm, sut = self.replicas[replica]
         # split string of commands into list (deliminator defined in stateleaner socket.properties)
         input_symbols = input_query.split(";")
         output_symbols = []
         state_coverage = []
         query_timestamps = []
+        len_preseed = 0
         if "enable_preseed" in self.config["slime_config"] and self.config["slime_config"]["enable_preseed"]:
             input_symbols = self.config["slime_config"]["preseed"] + input_symbols
+            len_preseed = len(self.config["slime_config"]["preseed"])
         len_input_symbols = len(input_symbols)
+        history_marks = self.history_marks if not self.args.i else None
         if self.args.i:
             self.config["slime_config"]["ludicrous_speed"] = False
             len_input_symbols = 9000 # lazy hack so interactive mode doesn't stop early, no one would go over 9000
         query_timestamps.append(time.time())
-        for cmd_index in range(-1, len_input_symbols):
+        first_index = -1
+        if live is not None:
+            # continue the live session of a prefix of this query instead of replaying it
+            output_symbols = list(live["output_symbols"])
+            state_coverage = list(live["state_coverage"])
+            # shifted so the time the session sat idle doesn't count towards the next transition
+            idle = time.time() - live["query_timestamps"][-1]
+            query_timestamps = [timestamp + idle for timestamp in live["query_timestamps"]]
+            first_index = len(output_symbols) - 1
+            # one fuzzer session per query like for restarted sessions, starting from what the live session had
+            mitm.fuzzer_data.new_session(live["fuzzer"])
+        finished = False
+        for cmd_index in range(first_index, len_input_symbols):
+            if abort is not None and abort.is_set():
+                # speculative session, the replica is needed for a query from the learner
+                return None, "", {}
             # start at -1 and increment at start of loop
             # select command with support for interactive mode
             cmd_index += 1
@@ -211,6 +301,7 @@ class SLIME:
                 else:
                     cmd = cmd_next
             if cmd == "DONE":
+                finished = True
                 break
             # error until proven otherwise
             response = "ERROR"
@@ -234,8 +325,9 @@ class SLIME:
             except Exception:
                 raise ValueError("cmd not specified properly")
             ## return_source = cmd[4]
-            # get code coverage at current state before cmd/mitm action
-            state_coverage.append(self.sut.get_traces())
+            # get code coverage at current state before cmd/mitm action, a continued session already has it from the end of the live session
+            if len(state_coverage) <= cmd_index:
+                state_coverage.append(sut.get_traces())
             # send command to SUT if provided
             if input_type == "s":
                 pass
@@ -243,7 +335,13 @@ class SLIME:
                 # Might want to grab coverage here again
             # send command to mitm if provided (first available if no name provided, TODO (maybe): select specific mitm)
             elif input_type == "m":
-                response = self.mitm.process_action(action)
+                if history_marks and cmd_index >= len_preseed:
+                    prefix = ";".join(input_symbols[len_preseed:cmd_index])
+                    history_marks.mark(prefix, mitm.fuzzer_data.session_history, output_symbols[len_preseed:])
+                mitm.prefix = ";".join(input_symbols[:cmd_index])
+                response = mitm.process_action(action)
+                if history_marks and cmd_index >= len_preseed and mitm.forwarded is not None:
+                    history_marks.forwarded(prefix, mitm.forwarded)
             # select the correct return source for the output alphabet symbol
             # TODO: use a dict for response (rename) with request, response
             output_symbols.append(response)
@@ -254,12 +352,35 @@ class SLIME:
                 while len(output_symbols) < len(input_symbols):
                     output_symbols.append(response)
                 break
+            if self.config["slime_config"]["ludicrous_speed"] and self.log.is_sink(response):
+                while len(output_symbols) < len(input_symbols):
+                    output_symbols.append(response)
+                break
             if self.config["slime_config"]["ludicrous_speed"] and response.split("-")[-1] == "null":
                 # TODO Create flag for null request terminates as noflow
                 while len(output_symbols) < len(input_symbols):
                     output_symbols.append("noflow")
                 break
 
+        if abort is not None and abort.is_set():
+            # aborted while listening, the timeout that ended the last action wasn't real
+            return None, "", {}
+
+        # also need coverage at the end of each session
+        state_coverage.append(sut.get_traces())
+
+        # the session can be continued if it wasn't cut short
+        self.live_sessions[replica] = None
+        if self.lazy_teardown and finished:
+            self.live_sessions[replica] = {
+                "query": input_query,
+                "output_symbols": list(output_symbols),
+                "state_coverage": list(state_coverage),
+                "query_timestamps": list(query_timestamps),
+                "fuzzer": mitm.fuzzer_data.session(),
+                "time": time.time()
+            }
+
         # finished testing query
         if output_symbols == []:
             # something weird happened or LL is done?
@@ -270,18 +391,203 @@ class SLIME:
                 output_symbols = output_symbols[len(self.config["slime_config"]["preseed"]):]
                 query_timestamps = query_timestamps[len(self.config["slime_config"]["preseed"]):]
             query_response = ";".join(output_symbols)
-        # also need coverage at the end of each session
-        state_coverage.append(self.sut.get_traces())
 
         # convert time to time diff strings
         query_timediffs = [str(query_timestamps[i+1] - query_timestamps[i]) for i in range(len(query_timestamps)-1)]
         query_timediffs = ";".join(query_timediffs)
 
-        # log traces, locals for debugging, and return response
-        self.log.update_entry("plaid_msg", self.mitm.fuzzer_data.get_plaid_msg())
-        self.log.update_entry("traces", state_coverage)
+        # return response with traces for the log, sessions on other replicas may be running so the log entry is written by the caller
+        extras = {
+            "plaid_msg": mitm.fuzzer_data.get_plaid_msg(),
+            "traces": state_coverage
+        }
         self.learning_session_locals = locals()
-        return query_response, query_timediffs
+        return query_response, query_timediffs, extras
+
+    @loguru_decorator
+    def runQuery(self, input_query: str, replica: int = 0, mitm_process_ctrl: Bugs = None, abort: threading.Event = None) -> tuple[str, str, dict]:
+        """restart the SUTs of a replica and run one learning session on it, the response is None if it was aborted
+        with lazy teardown the live session of the replica is continued instead if the query extends it"""
+        mitm, sut = self.replicas[replica]
+        mitm.abort = abort
+        live = self.live_sessions[replica]
+        if self.continues(replica, input_query):
+            with self.stats_lock:
+                self.continuations += 1
+            print("\033[94mcontinuing session of %s\033[0m" % live["query"])
+        else:
+            live = None
+            self.teardown(replica, mitm_process_ctrl)
+            if mitm_process_ctrl:
+                mitm.clearQueues()
+                mitm_process_ctrl.request("start")
+            self.startSuts(replica, abort)
+        self.live_sessions[replica] = None
+        query_response, query_timediffs, extras = self.learningSession(input_query, replica, abort, live)
+        if self.live_sessions[replica] is None:
+            self.teardown(replica, mitm_process_ctrl, True)
+        return query_response, query_timediffs, extras
+
+    @loguru_decorator
+    def continues(self, replica: int, input_query: str) -> bool:
+        """whether the query extends the live session of a replica"""
+        live = self.live_sessions[replica]
+        return live is not None and input_query.startswith(live["query"] + ";") and time.time() - live["time"] < self.lazy_teardown
+
+    @loguru_decorator
+    def teardown(self, replica: int, mitm_process_ctrl: Bugs = None, force: bool = False):
+        """kill the SUTs of a replica after a session, unless they were already killed"""
+        if not force and self.live_sessions[replica] is None:
+            return
+        mitm, sut = self.replicas[replica]
+        self.live_sessions[replica] = None
+        self.killSuts(replica)  # might be better before where log was written before restarting sut, but if they fail to restart, maybe session had an issue and response discarded
+        if mitm_process_ctrl:
+            mitm_process_ctrl.request("stop")
+            mitm.clearQueues()
+
+    @loguru_decorator
+    def dispatchLoop(self, mitm_process_ctrls: list):
+        """learning loop for several replicas, queries are handed to free replicas and answered as they finish
+        only useful if the learner has several queries outstanding, ie it sends batch frames or several learners are connected, or with speculation
+        speculative queries are aborted as soon as a query from the learner needs their replica"""
+        free = list(reversed(range(len(self.replicas))))
+        # future -> [query, replica, origin, abort event (None once the learner asked for the query), start time]
+        running = {}
+        waiting = collections.deque()
+        learner_done = False
+        with concurrent.futures.ThreadPoolExecutor(len(self.replicas), thread_name_prefix="replica") as pool:
+            def submit(input_query: str, origin: tuple, abort: threading.Event = None):
+                assert psutil.virtual_memory().percent < 90
+                assert psutil.disk_usage(os.getcwd()).percent < 99
+                # a replica whose live session the query extends if there is one
+                replica = next((replica for replica in free if self.continues(replica, input_query)), free[-1])
+                free.remove(replica)
+                print("\033[93m%s replica %s\033[0m - %s" % ("speculating on" if abort else "querying", replica, time.ctime()))
+                running[pool.submit(self.runQuery, input_query, replica, mitm_process_ctrls[replica], abort)] = [input_query, replica, origin, abort, time.time()]
+
+            def abort_speculation():
+                for entry in running.values():
+                    if entry[3] is not None:
+                        entry[3].set()
+
+            while running or waiting or not learner_done:
+                while waiting and free:
+                    submit(*waiting.popleft())
+                speculating = any(entry[3] is not None for entry in running.values())
+                if not learner_done and (free or speculating):
+                    speculate = self.speculator is not None and len(free) > self.speculator.reserve and not waiting
+                    # only block on the learner while nothing is running or to be speculated
+                    input_query = self.ll.listen(0.05 if running or speculate else None)
+                    if input_query == "":
+                        learner_done = True
+                        abort_speculation()
+                    elif input_query is not None:
+                        origin = getattr(self.ll, "current", ())
+                        print("\033[92minput query:\033[0m " + input_query)
+                        if self.speculator is not None:
+                            self.speculator.observe(input_query)
+                        # a speculation that was already told to abort returns nothing, the query is run again instead
+                        speculative = next((entry for entry in running.values() if entry[0] == input_query and entry[3] is not None and not entry[3].is_set()), None)
+                        query_response = None if speculative else self.lookupQuery(input_query)
+                        if speculative:
+                            # already running, answer it once it finishes
+                            print("\033[94mquery is already being speculated\033[0m")
+                            self.speculator.hit(time.time() - speculative[4])
+                            speculative[2], speculative[3] = origin, None
+                        elif query_response is not None:
+                            print("\033[94mfound matching query in cache\033[0m")
+                            self.answerQuery(input_query, query_response, "", {}, origin)
+                        elif free:
+                            submit(input_query, origin)
+                        else:
+                            waiting.append((input_query, origin))
+                            abort_speculation()
+                        continue
+                    elif speculate:
+                        queued = {entry[0] for entry in running.values()}
+                        input_query = self.speculator.next_query(lambda query: query in queued or self.lookupQuery(query, True) is not None)
+                        if input_query is not None:
+                            print("\033[92mspeculative query:\033[0m " + input_query)
+                            submit(input_query, (), threading.Event())
+                            continue
+                if running:
+                    can_listen = not learner_done and (free or speculating)
+                    finished, _ = concurrent.futures.wait(running, timeout=0 if can_listen else None, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        input_query, replica, origin, abort, start = running.pop(future)
+                        free.append(replica)
+                        query_response, query_timediffs, extras = future.result()
+                        if abort is None:
+                            self.storeQuery(input_query, query_response, query_timediffs, extras)
+                            self.answerQuery(input_query, query_response, query_timediffs, extras, origin)
+                        elif query_response is None:
+                            self.speculator.aborted += 1
+                        else:
+                            # cached and logged, but not used by the learner (yet)
+                            self.storeQuery(input_query, query_response, query_timediffs, extras)
+                            self.logQuery(input_query, query_response, query_timediffs, extras, False)
+                            self.speculator.speculated[input_query] = time.time() - start
+        raise EOFError("cmd list is empty")
+
+    @loguru_decorator
+    def lookupQuery(self, input_query: str, speculative: bool = False) -> str:
+        """answer a query from the cache, or from a dry run of its next action on the session history of its longest prefix run before
+        speculative lookups are for queries the learner didn't ask (yet), they leave the counters and sink verification alone"""
+        query_response = self.log.lookup_query(input_query, speculative=speculative)
+        if query_response is not None or self.history_marks is None:
+            return query_response
+        query_split = input_query.split(";")
+        for i in range(len(query_split) - 1, -1, -1):
+            mark = self.history_marks.get(";".join(query_split[:i]))
+            if mark is not None:
+                break
+        else:
+            return None
+        session_history, output_symbols, forwarded = mark
+        cmd = query_split[i].split("-")
+        if forwarded is None or cmd[0] != "m" or len(cmd) not in [3, 4]:
+            return None
+        return_code, passthrough = self.mitm.dry_run(cmd[-2], session_history)
+        if not passthrough:
+            return None
+        if not forwarded:
+            # nothing came back after passing the message on before either
+            response = "noflow"
+        elif return_code not in [0, 2]:
+            # action not applicable, message is passed on and the session terminates once the next one arrives
+            response = "term"
+        else:
+            return None
+        if speculative:
+            return ";".join(output_symbols + [response] * (len(query_split) - i))
+        self.dry_run_count += 1
+        print("\033[94mdry run, next action after %s previous symbols is %s\033[0m" % (i, response))
+        return ";".join(output_symbols + [response] * (len(query_split) - i))
+
+    @loguru_decorator
+    def storeQuery(self, input_query: str, query_response: str, query_timediffs: str, extras: dict):
+        """keep a response measured on the SUTs in the query store"""
+        if self.query_store:
+            with self.mitm.parser_data.lock:
+                self.query_store.put(input_query, query_response, extras.get("plaid_msg"), self.mitm.parser_data.output_alphabet_symbols, self.mitm.parser_data.output_alphabet_examples, self.mitm.parser_data.version)
+
+    @loguru_decorator
+    def answerQuery(self, input_query: str, query_response: str, query_timediffs: str, extras: dict, origin: tuple = ()):
+        """log a finished query and send the response to the learner it came from"""
+        self.logQuery(input_query, query_response, query_timediffs, extras, True)
+        self.ll.send(query_response, *origin)
+
+    @loguru_decorator
+    def logQuery(self, input_query: str, query_response: str, query_timediffs: str, extras: dict, used_query: bool):
+        print("\033[92mres:\033[0m " + str(query_response))
+        self.log.new_entry()
+        self.log.update_entry("query", input_query)
+        for label in extras:
+            self.log.update_entry(label, extras[label])
+        self.log.update_entry("response", query_response)
+        self.log.update_entry("transition_times", query_timediffs)
+        self.log.write_entry(used_query)
 
     @loguru_decorator
     def learningLoop(self):
@@ -289,12 +595,18 @@ class SLIME:
             if self.args.n:
                 raise Exception("No run")
             use_mitm_process_ctrl = False
-            mitm_process_ctrl = Bugs("mitm_process_ctrl", False)
             for mitm in self.config["mitm_controllers"]:
                 if "restart_between_sessions" in self.config["mitm_controllers"][mitm] and self.config["mitm_controllers"][mitm]["restart_between_sessions"]:
                     assert not use_mitm_process_ctrl, "Only one mitm can be set to restart between sessions"
                     use_mitm_process_ctrl = True
+            # one mitm process controller per replica (or None)
+            mitm_process_ctrls = [None] * len(self.replicas)
+            if use_mitm_process_ctrl:
+                mitm_process_ctrls = [Bugs("mitm_process_ctrl", False, replica_config(self.config_template, replica)["slime_config"].get("broker")) for replica in range(len(self.replicas))]
+            self.mitm_process_ctrls = mitm_process_ctrls
             print("Starting learning loop")
+            if (len(self.replicas) > 1 or self.speculator is not None) and not self.args.i:
+                self.dispatchLoop(mitm_process_ctrls)
             while True:
                 # better to stop and resume later if memory leak than ruin results with non-deterministic timeouts
                 assert psutil.virtual_memory().percent < 90
@@ -321,22 +633,15 @@ class SLIME:
                 self.log.new_entry()
                 self.log.update_entry("query", input_query)
                 if lookup_query:
-                    query_response = self.log.lookup_query(input_query)
+                    query_response = self.lookupQuery(input_query)
                 else:
                     query_response = None
                 if query_response is None:
                     print("\033[93mquerying sut(s)\033[0m")
-                    if use_mitm_process_ctrl:
-                        self.mitm.clearQueues()
-                        mitm_process_ctrl.send("start")
-                        mitm_process_ctrl.listen()
-                    self.startSuts()
-                    query_response, query_timediffs = self.learningSession(input_query)
-                    self.killSuts()  # might be better before where log was written before restarting sut, but if they fail to restart, maybe session had an issue and response discarded
-                    if use_mitm_process_ctrl:
-                        mitm_process_ctrl.send("stop")
-                        mitm_process_ctrl.listen()
-                        self.mitm.clearQueues()
+                    query_response, query_timediffs, extras = self.runQuery(input_query, 0, mitm_process_ctrls[0])
+                    self.storeQuery(input_query, query_response, query_timediffs, extras)
+                    for label in extras:
+                        self.log.update_entry(label, extras[label])
                 else:
                     query_timediffs = ""
                     print("\033[94mfound matching query in cache\033[0m")
@@ -371,12 +676,40 @@ class SLIME:
     def writeLogs(self):
         self.log.write_entry("unknown")
         self.log.close()
+        if self.query_store:
+            self.query_store.close()
+        if self.log.plaid:
+            print(self.log.plaid_report())
+        if self.log.sink_observations:
+            print(self.log.sink_report())
+        if self.history_marks is not None:
+            print("Answered %s queries from dry runs on the session history" % self.dry_run_count)
+        if self.speculator is not None:
+            print(self.speculator.report())
+        if self.lazy_teardown:
+            print("Continued %s live sessions instead of restarting the SUTs" % self.continuations)
+        for stage, (count, seconds) in self.restart_times.items():
+            if count:
+                print("SUT %s: %s times, %.3fs on average, %.1fs in total" % (stage, count, seconds / count, seconds))
+        if self.latency is not None:
+            self.latency.save()
+            print(self.latency.report())
+        if self.quiescence is not None:
+            print(self.quiescence.report())
         self.mitm.parser_data.writeSymbols()
         self.mitm.parser_data.writeParserErrors()
-        self.mitm.fuzzer_data.close_log()
+        for mitm, sut in self.replicas:
+            mitm.fuzzer_data.close_log()
+            if sut.readiness_report():
+                print(sut.readiness_report())
+            for q in [sut.q(sut_name) for sut_name in sut.names()] + [mitm.controller.q]:
+                if q.compression_report():
+                    print(q.compression_report())
 
     @loguru_decorator
     def endLearning(self):
+        for replica in range(len(self.replicas)):
+            self.teardown(replica, self.mitm_process_ctrls[replica])
         self.writeLogs()
         self.ll.close()
         environment = {}
@@ -9,13 +9,25 @@ import re
 import shutil
 import subprocess
 import shlex
+import signal
 import sys
+import threading
 import time
+import typing
 # Third party
 import psutil
 # Local
-from .utils import loguru_decorator, for_all_methods
+from .utils import loguru_decorator, for_all_methods, wait_until
 from .msgbroker import Bugs
+from . import readiness
+
+
+def zombie(p: psutil.Process) -> bool:
+    """whether the process exited, even if it wasn't reaped yet"""
+    try:
+        return p.status() == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return True
 
 
 @for_all_methods(loguru_decorator)
@@ -24,6 +36,10 @@ class SUTController:
     def __init__(self, config: dict, name: str) ->  None:
         self.config = config
         self.name = name
+        # seconds the last run() waited for the SUT to be ready, None if it didn't wait
+        self.ready_latency = None
+        # threads reaping the processes of the last kill
+        self.reapers = []
 
     def run(self) -> None:
         raise NotImplementedError
@@ -46,15 +62,136 @@ class SUTController:
     def restore(self) -> None:
         raise NotImplementedError
 
+    def popen(self, cmd: str) -> subprocess.Popen:
+        """start cmd in the background in its own process group, with its stdout piped if the ready_probe reads it"""
+        stdout = None
+        if self.config.get("ready_probe") and self.config["ready_probe"]["type"] == "stdout":
+            stdout = subprocess.PIPE
+        return subprocess.Popen(shlex.split(cmd), stdout=stdout, universal_newlines=True, start_new_session=True)
+
+    def killpg(self, roots: list, sig: int = signal.SIGKILL, after: typing.Callable = None) -> None:
+        """send sig to the process groups of roots (pids or psutil.Process) and to their children that left those groups, eg under sudo
+        the processes are reaped in the background, whatever is still alive after kill_timeout seconds (5 by default) gets SIGKILL, then after() is called
+        reaped() waits for this, so the next session can be set up while the last one is torn down"""
+        procs = []
+        groups = []
+        for root in roots:
+            try:
+                root = root if isinstance(root, psutil.Process) else psutil.Process(root)
+                procs += [root] + root.children(recursive=True)
+                groups.append(root)
+            except psutil.NoSuchProcess:
+                pass
+        pgids = {}
+        for p in procs:
+            try:
+                pgids[p.pid] = os.getpgid(p.pid)
+            except ProcessLookupError:
+                pass
+        signalled = set()
+        for p in groups:
+            pgid = pgids.get(p.pid)
+            # never the group of the controller itself, eg a SUT started without a session of its own
+            if pgid is None or pgid in signalled or pgid == os.getpgrp():
+                continue
+            try:
+                os.killpg(pgid, sig)
+                signalled.add(pgid)
+            except OSError:
+                pass
+        for p in procs:
+            if pgids.get(p.pid) not in signalled:
+                try:
+                    p.send_signal(sig)
+                except psutil.NoSuchProcess:
+                    pass
+        reaper = threading.Thread(target=self.reap, args=(procs, self.config.get("kill_timeout", 5), after), name="reaper", daemon=True)
+        reaper.start()
+        self.reapers.append(reaper)
+
+    def reap(self, procs: list, timeout: float, after: typing.Callable = None) -> None:
+        deadline = time.monotonic() + timeout
+        alive = procs
+        while alive and time.monotonic() < deadline:
+            gone, alive = psutil.wait_procs(alive, min(0.05, max(0, deadline - time.monotonic())))
+            # orphans are zombies until init gets around to reaping them, they already let go of their ports and files
+            alive = [p for p in alive if not zombie(p)]
+        for p in alive:
+            print("%s: pid %s still running %ss after kill" % (self.name, p.pid, timeout))
+            try:
+                p.kill()
+            except psutil.NoSuchProcess:
+                pass
+        psutil.wait_procs(alive, timeout)
+        if after is not None:
+            after()
+
+    def reaped(self) -> None:
+        """wait until the processes of the last kill are gone"""
+        for reaper in getattr(self, "reapers", []):
+            reaper.join()
+        self.reapers = []
+
+    def ready(self, default: dict = None, proc: psutil.Process = None, stream: typing.IO = None, max_interval: float = 0.1) -> None:
+        """wait until the SUT is ready by the ready_probe in the config (see readiness.select_probe), or by default if there is none, giving up after ready_timeout seconds if set"""
+        ready_probe = self.config.get("ready_probe") or default
+        if not ready_probe:
+            return
+        probe = readiness.select_probe(ready_probe, proc or getattr(self, "proc", None), stream)
+        self.ready_latency = readiness.wait_ready(self.name, probe, self.config.get("ready_timeout"), max_interval)
+
+    def cmd_ready(self) -> dict:
+        """probe for cmd_ready if configured, it has to print "ready" once the SUT is"""
+        if "cmd_ready" in self.config and self.config["cmd_ready"]:
+            return {"type": "cmd", "cmd": self.config["cmd_ready"]}
+        return None
+
+    def activity_roots(self) -> list:
+        """processes whose trees make up the SUT for activity(), self.proc by default, controllers that keep their processes elsewhere override this"""
+        proc = getattr(self, "proc", None)
+        return [proc] if proc is not None else []
+
+    def activity(self) -> tuple:
+        """(cpu seconds, bytes read and written, open connections) of the activity_roots() and their children, None if there are none
+        only has to change whenever the SUT does something, it is compared between samples by the quiescence detector"""
+        roots = self.activity_roots()
+        if not roots:
+            return None
+        cpu = 0.0
+        io = 0
+        connections = 0
+        procs = {}
+        for root in roots:
+            try:
+                for p in [root] + root.children(recursive=True):
+                    procs[p.pid] = p
+            except psutil.NoSuchProcess:
+                # a process that exited does nothing anymore
+                pass
+            except psutil.AccessDenied:
+                return None
+        for p in procs.values():
+            try:
+                with p.oneshot():
+                    times = p.cpu_times()
+                    cpu += times.user + times.system
+                    counters = p.io_counters()
+                    # read_chars/write_chars include sockets but are linux only
+                    io += getattr(counters, "read_chars", counters.read_bytes) + getattr(counters, "write_chars", counters.write_bytes)
+                    connections += len(p.connections())
+            except psutil.NoSuchProcess:
+                pass
+            except (psutil.AccessDenied, AttributeError):
+                return None
+        return cpu, io, connections
+
 
 @for_all_methods(loguru_decorator)
 class Simple_Ready_SUT(SUTController):
     """Simple SUT that is ready (to bring up the next SUT or start learning) when a string is printed to stdout via cmd_ready, also requires cmd_start and cmd_stop"""
     def run(self):
         subprocess.run(shlex.split(self.config["cmd_start"]))
-        if "cmd_ready" in self.config and self.config["cmd_ready"]:
-            while "ready" not in subprocess.run(shlex.split(self.config["cmd_ready"]), capture_output=True, universal_newlines=True).stdout:
-                time.sleep(0.2)
+        self.ready(self.cmd_ready(), max_interval=0.2)
 
     def kill(self):
         subprocess.run(shlex.split(self.config["cmd_stop"]))
@@ -63,48 +200,33 @@ class Simple_Ready_SUT(SUTController):
 
 @for_all_methods(loguru_decorator)
 class Simple_Client_SUT(Simple_Ready_SUT):
-    """Simple SUT that is ready immediately, and requires cmd_start and cmd_stop"""
+    """Simple SUT that is ready immediately (unless there is a ready_probe), and requires cmd_start and cmd_stop"""
     def run(self):
-        subprocess.Popen(shlex.split(self.config["cmd_start"]))
+        p = self.popen(self.config["cmd_start"])
+        self.proc = psutil.Process(p.pid)
+        self.ready(stream=p.stdout)
 
 
 @for_all_methods(loguru_decorator)
 class Simple_Server_SUT(Simple_Ready_SUT):
     """Simple SUT that is ready when bound to listen_port, or any port if not specified, requires cmd_start and cmd_stop"""
     def run(self):
-        proc = subprocess.Popen(shlex.split(self.config["cmd_start"]))
+        proc = self.popen(self.config["cmd_start"])
         self.proc = psutil.Process(proc.pid)
-        if "listen_port" in self.config:
-            while not any(c.laddr.port == self.config["listen_port"] for c in psutil.net_connections() if c.status == "LISTEN"):
-                time.sleep(0.1)
-        else:
-            while not (any(p.connections() for p in self.proc.children(recursive=True)) or self.proc.connections()):
-                time.sleep(0.1)
+        self.ready({"type": "proc_net", "port": self.config.get("listen_port")}, stream=proc.stdout)
 
 
 @for_all_methods(loguru_decorator)
 class Simple_Kill_Client_SUT(SUTController):
-    """Simple SUT that is ready immediately, requires only cmd_start (kill is handled by SUTController)"""
+    """Simple SUT that is ready immediately (unless there is a ready_probe), requires only cmd_start (kill is handled by SUTController)"""
     def run(self):
-        self.p = subprocess.Popen(shlex.split(self.config["cmd_start"]))
+        self.p = self.popen(self.config["cmd_start"])
         self.proc = psutil.Process(self.p.pid)
+        self.ready(stream=self.p.stdout)
 
     def kill(self):
-        # kill process and all children, and make sure they are dead
-        for child in self.proc.children(recursive=True):
-            try:
-                child.kill()
-            except psutil.NoSuchProcess:
-                pass
-        try:
-            self.proc.kill()
-        except psutil.NoSuchProcess:
-            pass
-        while self.proc.is_running():
-            try:
-                self.proc.kill()
-            except psutil.NoSuchProcess:
-                break
+        # kill the process group of the SUT and any children outside of it, they are made sure to be dead before the next run
+        self.killpg([self.proc])
 
 
 @for_all_methods(loguru_decorator)
@@ -121,12 +243,13 @@ class Simple_Kill_Server_SUT(Simple_Kill_Client_SUT, Simple_Server_SUT):
 class Simple_Root_Client_SUT(Simple_Kill_Client_SUT):
     """Like Simple_Kill_Client_SUT but runs as root, and runs cmd_start in a subprocess with sudo -i -u $SUDO_USER"""
     def run(self):
+        self.sudo_start()
+        self.ready()
+
+    def sudo_start(self):
         args = ["sudo", "-i", "-u", os.getenv('SUDO_USER'), "bash", "-c", f"cd \"{os.getcwd()}\";{self.config['cmd_start']} & echo $! > slime-{self.name}.pid"]
-        subprocess.Popen(args)
-        for _ in range(10):
-            if os.path.exists(f"slime-{self.name}.pid"):
-                break
-            time.sleep(0.1)
+        subprocess.Popen(args, start_new_session=True)
+        wait_until(readiness.file_probe(f"slime-{self.name}.pid"), 1)
         with open(f"slime-{self.name}.pid", "r") as f:
             self.pid = int(f.read())
         os.remove(f"slime-{self.name}.pid")
@@ -137,13 +260,10 @@ class Simple_Root_Client_SUT(Simple_Kill_Client_SUT):
 class Simple_Root_Server_SUT(Simple_Kill_Client_SUT):
     """Like Simple_Kill_Server_SUT but runs as root, and runs cmd_start in a subprocess with sudo -i -u $SUDO_USER"""
     def run(self):
-        super().run()
-        if "listen_port" in self.config:
-            while not any(c.laddr.port == self.config["listen_port"] for c in psutil.net_connections() if c.status == "LISTEN"):
-                time.sleep(0.1)
-        else:
-            while not (any(p.connections() for p in self.proc.children(recursive=True)) or self.proc.connections()):
-                time.sleep(0.1)
+        # cmd_start is started like in Simple_Kill_Client_SUT.run, which is what this always ran, not through sudo_start
+        self.p = self.popen(self.config["cmd_start"])
+        self.proc = psutil.Process(self.p.pid)
+        self.ready({"type": "proc_net", "port": self.config.get("listen_port")}, stream=self.p.stdout)
 
 
 class SUT_uflow(SUTController):
@@ -167,73 +287,71 @@ class SUT_uflow(SUTController):
     def run(self):
         if "cmd_startup" in self.config and self.config["cmd_startup"]:
             subprocess.run(shlex.split(self.config["cmd_startup"]))
-            time.sleep(0.5)
-        self.client = subprocess.Popen(shlex.split(self.config["cmd_run"]), stdout=subprocess.PIPE, universal_newlines=True)
-        time.sleep(0.5)
+        self.client = subprocess.Popen(shlex.split(self.config["cmd_run"]), stdout=subprocess.PIPE, universal_newlines=True, start_new_session=True)
         print("PID")
         if "cmd_pid" in self.config:
-            pid = subprocess.run(shlex.split(self.config["cmd_pid"]), capture_output=True, universal_newlines=True).stdout
+            # polled until the SUT process shows up
+            pid = wait_until(lambda: subprocess.run(shlex.split(self.config["cmd_pid"]), capture_output=True, universal_newlines=True).stdout.strip(), self.config.get("ready_timeout"))
+            if not pid:
+                raise TimeoutError("%s has no pid after %ss" % (self.name, self.config["ready_timeout"]))
         else:
             pid = str(int(self.client.stdout.read().strip()))
-        self.tmp_pid = pid  # try killing processes that have uflow and this pid in the command line to get rid of zombies
         print(pid)
-        self.tracer = subprocess.Popen(shlex.split(self.config["cmd_uflow"]) + [pid], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        self.pid = int(pid)
+        self.tracer = subprocess.Popen(shlex.split(self.config["cmd_uflow"]) + [pid], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, start_new_session=True)
         self.q_trace = multiprocessing.Queue()
         self.p_trace = multiprocessing.Process(name="tracer", target=self._tracer, args=(self.tracer, self.q_trace))
         self.p_trace.start()
-        if "cmd_ready" in self.config and self.config["cmd_ready"]:
-            while "ready" not in subprocess.run(shlex.split(self.config["cmd_ready"]), capture_output=True, universal_newlines=True).stdout:
-                time.sleep(0.5)
+        self.ready(self.cmd_ready(), max_interval=0.5)
         # time.sleep(1)
         # subprocess.run(shlex.split(self.config["cmd_is_ready"]))
 
+    @loguru_decorator
+    def activity_roots(self):
+        # the SUT isn't necessarily a child of cmd_run, and the tracer prints whenever the SUT does something
+        pids = [getattr(self, "pid", None)] + [getattr(getattr(self, p, None), "pid", None) for p in ["client", "tracer"]]
+        roots = []
+        for pid in pids:
+            try:
+                if pid is not None:
+                    roots.append(psutil.Process(pid))
+            except psutil.NoSuchProcess:
+                pass
+        return roots
+
     @loguru_decorator
     def kill(self):
-        # todo: make this more robust (check if killed, do async to improve performance, etc)
+        # the tracer and client have process groups of their own, uflow itself is found among the children of the tracer (eg under sudo) instead of scanning every process
+        # cmd_stop runs once they are gone, in the background like the rest of the teardown
+        self.killpg([self.tracer.pid, self.client.pid], signal.SIGTERM, lambda: subprocess.run(shlex.split(self.config["cmd_stop"])))
+        # the reader process ends with the tracer's stdout, it is reaped by multiprocessing when the next one starts
         self.p_trace.terminate()
-        self.p_trace.join(0.5)
-        if self.p_trace.is_alive():
-            self.p_trace.kill()
-        self.p_trace.close()
         self.q_trace.close()
         self.tracer.stdout.close()
-        self.tracer.terminate()
-        try:
-            self.tracer.wait(0.5)
-        except subprocess.TimeoutExpired:
-            self.tracer.kill()
-        self.tracer.wait()
-        del(self.tracer)
         self.client.stdout.close()
-        self.client.terminate()
-        try:
-            self.client.wait(0.5)
-        except subprocess.TimeoutExpired:
-            self.client.kill()
-        self.client.wait()
+        del(self.tracer)
         del(self.client)
-        for proc in psutil.process_iter(attrs=["name", "cmdline", "pid"], ad_value=""):
-            proc = proc.info
-            if "uflow" in proc["name"] and self.tmp_pid in proc["cmdline"]:
-                proc = psutil.Process(proc["pid"])
-                proc.terminate()
-                try:
-                    proc.wait(0.5)
-                except psutil.TimeoutExpired:
-                    proc.kill()
-                break
-        subprocess.run(shlex.split(self.config["cmd_stop"]))
+        self.pid = None
 
     @loguru_decorator
     def trace(self):
+        # the tracer lags behind the SUT, by default it gets up to 1s for the first line of the trace
+        # with trace_quiet set it counts as flushed once it printed nothing for trace_quiet seconds instead (or after trace_timeout seconds), only for tracers known to start printing within that window
         trace = ""
         try:
-            time.sleep(0.1)
-            trace += self.q_trace.get(timeout=1)
-            trace += self.q_trace.get(timeout=0.1)
-            trace += self.q_trace.get(timeout=0.1)
-            while True:
-                trace += self.q_trace.get(block=False)
+            if "trace_quiet" in self.config:
+                quiet = self.config["trace_quiet"]
+                deadline = time.monotonic() + self.config.get("trace_timeout", 1)
+                # checked before every get, a tracer that keeps printing never leaves the queue empty
+                while time.monotonic() < deadline:
+                    trace += self.q_trace.get(timeout=max(0, min(quiet, deadline - time.monotonic())))
+            else:
+                time.sleep(0.1)
+                trace += self.q_trace.get(timeout=1)
+                trace += self.q_trace.get(timeout=0.1)
+                trace += self.q_trace.get(timeout=0.1)
+                while True:
+                    trace += self.q_trace.get(block=False)
         except queue.Empty:
             pass
         trace = "\n".join(filter(self.trace_filter.match, trace.splitlines()))
@@ -254,9 +372,8 @@ class SUT_uflow_no_tracing(Simple_Ready_SUT):
     def run(self):
         subprocess.run(shlex.split(self.config["cmd_startup"]))
         self.client = subprocess.Popen(shlex.split(self.config["cmd_run"]), stdout=subprocess.PIPE, universal_newlines=True)
-        if "cmd_ready" in self.config and self.config["cmd_ready"]:
-            while "ready" not in subprocess.run(shlex.split(self.config["cmd_ready"]), capture_output=True, universal_newlines=True).stdout:
-                time.sleep(0.2)
+        self.proc = psutil.Process(self.client.pid)
+        self.ready(self.cmd_ready(), max_interval=0.2)
 
     def kill(self):
         subprocess.run(shlex.split(self.config["cmd_stop"]))
@@ -268,8 +385,8 @@ class SUT_callgrind(SUTController):
 
 
 @loguru_decorator
-def start_sutctrl(config: dict, name: str, user_module = None):
-    q = Bugs(name, False)
+def start_sutctrl(config: dict, name: str, user_module = None, broker: dict = None):
+    q = Bugs(name, False, broker)
     q.initQueues()
     # sut = Container2(config["container_type"], name, config["container_image"], config["startup_cmd"], config["trace_cmd"], config)
     if user_module and hasattr(user_module, config["controller_class"]):
@@ -288,38 +405,57 @@ def start_sutctrl(config: dict, name: str, user_module = None):
         elif sut_cmd == "KILL":
             print("killing")
             sut.kill()
-            q.send("KILLED")
+            q.reply("KILLED")
             print("killed")
+            if q.compression_report():
+                print(q.compression_report())
         elif sut_cmd == "START":
             print("starting")
-            sut.run()
-            q.send("STARTED")
-            print("started")
+            sut.ready_latency = None
+            # the SUT may still be torn down from the last session
+            sut.reaped()
+            try:
+                sut.run()
+            except TimeoutError as e:
+                # ready_timeout ran out, slime counts the failure and carries on with the SUT as it is
+                q.reply("FAILED %s" % e)
+                print("failed, %s" % e)
+                continue
+            if getattr(sut, "ready_latency", None) is None:
+                q.reply("STARTED")
+                print("started")
+            else:
+                # slime keeps per SUT readiness latencies from these
+                q.reply("STARTED %s" % sut.ready_latency)
+                print("started, ready after %.3fs" % sut.ready_latency)
         elif sut_cmd == "GETTRACE":
             print("get trace")
             trace = sut.trace()
-            q.send(trace)
+            q.reply(trace)
             print("got trace")
+        elif sut_cmd == "ACTIVITY":
+            # polled while slime waits for a message, not printed
+            q.reply(sut.activity())
         elif sut_cmd == "CHECKPOINT":
             print("saving checkpoint")
             sut.checkpoint()
-            q.send("CHECKPOINT COMPLETE")
+            q.reply("CHECKPOINT COMPLETE")
             print("checkpoint saved")
         elif sut_cmd == "RESTORE":
             print("restoring checkpoint")
             sut.checkpoint()
-            q.send("RESTORE COMPLETE")
+            q.reply("RESTORE COMPLETE")
             print("checkpoint restored")
         elif sut_cmd == "STDOUT":
             print("get stdout")
             output = sut.stdout()
-            q.send(output)
+            q.reply(output)
             print("got stdout")
         elif sut_cmd in config["sut_input_alphabet"]:
             # don't need to error check this since exception raised next anyways if not in here
             print(sut_cmd)
             sut.stdin(config["sut_input_alphabet"][sut_cmd])
-            q.send("STDIN")
+            q.reply("STDIN")
             print("send cmd")
         else:
             raise Exception(sut_cmd)
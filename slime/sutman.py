@@ -1,13 +1,16 @@
+import asyncio
 import typing
 
 from .utils import loguru_decorator
-from .msgbroker import Bugs
+from .msgbroker import Bugs, AsyncBugs
 from .msgparser import MessageParser, MessageParserData, select_msgparser
 
 class SutManager:
     @loguru_decorator
-    def __init__(self, sut_config:dict, user_module = None):
+    def __init__(self, sut_config:dict, user_module = None, broker:dict = None):
         self.sut_queues = {}
+        self.sut_async_queues = {}
+        self.loop = asyncio.new_event_loop()
         self.parser_data = MessageParserData() # TODO: should be shared with mitm too maybe? so symbols are shared with stdout (but also stdout is another type so shouldn't matter)
         self.sut_parsers = {}
         self.sut_by_order = []
@@ -17,9 +20,10 @@ class SutManager:
             self.sut_queues[sut_name] = Bugs(
                 sut_name,
                 True,
-                remote_credentials=sut_config[sut_name]["remote_credentials"]
+                remote_credentials=sut_config[sut_name]["remote_credentials"] or broker
             )
             self.sut_queues[sut_name].initQueues()
+            self.sut_async_queues[sut_name] = AsyncBugs(self.sut_queues[sut_name])
             # init parser
             self.sut_parsers[sut_name] = select_msgparser(self.parser_data, sut_config[sut_name]["msg_parser"], user_module)
             # whether tracing is enabled, outside of controller_options because it lets slime know whether the controller_class supports tracing
@@ -27,6 +31,10 @@ class SutManager:
                 self.sut_to_trace.append(sut_name)
             # order sut appears in config.json, this is also the startup order
             self.sut_by_order.append(sut_name)
+        # starts, total and longest seconds each SUT took to become ready, from the START replies of controllers that wait for it
+        self.ready_times = {}
+        # starts that ran out of ready_timeout
+        self.start_failures = {}
 
     @loguru_decorator
     def len(self) -> int:
@@ -48,11 +56,65 @@ class SutManager:
             sut = self.sut_by_order[sut]
         return self.sut_parsers[sut]
 
+    @loguru_decorator
+    def new_epoch(self):
+        """stamp everything from here on with a new session epoch, so replies left over from the previous session are discarded"""
+        for sut_name in self.sut_by_order:
+            self.sut_queues[sut_name].new_epoch()
+
+    @loguru_decorator
+    def broadcast(self, cmd: str, sut_names: list = None) -> dict:
+        """send cmd to every SUT controller (or those in sut_names) at once and gather their replies, takes as long as the slowest controller"""
+        if sut_names is None:
+            sut_names = self.sut_by_order
+        async def gather():
+            return await asyncio.gather(*(self.sut_async_queues[sut_name].request(cmd) for sut_name in sut_names))
+        return dict(zip(sut_names, self.loop.run_until_complete(gather())))
+
+    @loguru_decorator
+    def start_all(self, parallel: bool = False) -> dict:
+        if parallel:
+            replies = self.broadcast("START")
+        else:
+            # default is one after another in config order, eg a client may need its server to be up first
+            replies = {}
+            for sut_name in self.sut_by_order:
+                replies[sut_name] = self.loop.run_until_complete(self.sut_async_queues[sut_name].request("START"))
+        for sut_name, reply in replies.items():
+            # "STARTED <seconds until ready>"
+            if str(reply).startswith("FAILED"):
+                self.start_failures[sut_name] = self.start_failures.get(sut_name, 0) + 1
+                continue
+            reply = str(reply).split()
+            if len(reply) == 2 and reply[0] == "STARTED":
+                latency = float(reply[1])
+                times = self.ready_times.setdefault(sut_name, [0, 0.0, 0.0])
+                times[0] += 1
+                times[1] += latency
+                times[2] = max(times[2], latency)
+        return replies
+
+    @loguru_decorator
+    def readiness_report(self) -> str:
+        """one line per SUT with how long it took to become ready and how often it wasn't within ready_timeout, empty if no controller reported either"""
+        report = []
+        for sut_name, (count, seconds, longest) in self.ready_times.items():
+            report.append("%s ready after %.3fs on average, %.3fs at most (%s starts)" % (sut_name, seconds / count, longest, count))
+        for sut_name, failures in self.start_failures.items():
+            report.append("%s not ready within ready_timeout (%s starts)" % (sut_name, failures))
+        return "\n".join(report)
+
+    @loguru_decorator
+    def kill_all(self) -> dict:
+        return self.broadcast("KILL")
+
     @loguru_decorator
     def get_traces(self) -> dict:
-        traces = {}
-        for sut_name in self.sut_to_trace:
-            self.q(sut_name).send("GETTRACE")
-            trace = self.q(sut_name).listen()
-            traces[sut_name] = trace
-        return traces
+        if not self.sut_to_trace:
+            return {}
+        return self.broadcast("GETTRACE", self.sut_to_trace)
+
+    @loguru_decorator
+    def get_activity(self) -> dict:
+        """(cpu seconds, io bytes, connections) of the processes of every SUT, None for SUTs whose controller can't tell"""
+        return self.broadcast("ACTIVITY")
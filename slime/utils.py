@@ -4,7 +4,14 @@ import json
 import os
 import typing
 import collections
+import hashlib
 import pickle
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import threading
 import time
 import inspect
 import types
@@ -60,6 +67,29 @@ def writeJson(fName:str, data:dict, indent:int = 1, skipkeys:bool = False) -> No
     with open(fName, "w", encoding="utf-8", errors="surrogateescape") as json_file:
         json.dump(data, json_file, indent=indent, separators=(',', ': '), skipkeys=skipkeys)
 
+def replica_config(config: dict, replica: int = 0) -> dict:
+    """config for one replica of the SUT/mitm environment, every string has ${REPLICA} replaced by the replica number and ${PORT:n} by n + replica * replica_port_stride
+    replicas other than 0 also get their own namespace on the broker so their queues don't mix"""
+    stride = config["slime_config"].get("replica_port_stride", 100)
+    def substitute(value):
+        if type(value) == str:
+            value = value.replace("${REPLICA}", str(replica))
+            return re.sub(r"\$\{PORT:(\d+)\}", lambda match: str(int(match.group(1)) + replica * stride), value)
+        elif isinstance(value, dict):
+            # readJson gives OrderedDicts, they come out as plain dicts
+            return {k: substitute(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [substitute(v) for v in value]
+        return value
+    config = substitute(config)
+    if replica:
+        namespace = "r%s-" % replica
+        config["slime_config"]["broker"] = dict(config["slime_config"].get("broker") or {}, namespace=namespace)
+        for sut_name in config["sut_controllers"]:
+            if isinstance(config["sut_controllers"][sut_name].get("remote_credentials"), dict):
+                config["sut_controllers"][sut_name]["remote_credentials"] = dict(config["sut_controllers"][sut_name]["remote_credentials"], namespace=namespace)
+    return config
+
 def writeCsv(fName:str, data:list, is_2d_array:bool = True) -> None:
     if not os.path.isdir(os.path.dirname(fName)):
         os.makedirs(os.path.dirname(fName))
@@ -90,8 +120,251 @@ def terminator(ports:list, useos:bool = True):
                 except:
                     print("ERROR: " + str(con))
 
+
+def wait_until(condition: typing.Callable, timeout: float = None, interval: float = 0.01, max_interval: float = 0.2):
+    """call condition until it returns something true and return that, sleeping interval in between and doubling it up to max_interval
+    returns the last (false) result if timeout seconds passed first, None waits forever"""
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    while True:
+        result = condition()
+        if result:
+            return result
+        if timeout is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return result
+            interval = min(interval, remaining)
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+# slime_config entries that change how a query is answered, the rest (eg statelearner settings) don't matter for the query store
+FINGERPRINT_SLIME_CONFIG = ["preseed", "enable_preseed", "mitm_timeout", "noflow_timeout", "ludicrous_speed", "plaid", "plaid_mode", "sink_symbols"]
+
+
+class QueryStore:
+    """query -> response cache in sqlite that outlives a run, so restarted or reordered learning jobs reuse every query already measured
+    entries are keyed by a fingerprint of everything that decides the response, a run with a different SUT, mitm, parser or fuzzer setup doesn't see them"""
+    def __init__(self, fname: str, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.db = sqlite3.connect(fname)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS queries (fingerprint TEXT NOT NULL, query TEXT NOT NULL, response TEXT NOT NULL, plaid_msg TEXT, PRIMARY KEY (fingerprint, query)) WITHOUT ROWID")
+            # responses are output symbol numbers, the alphabet that numbers them has to come along
+            self.db.execute("CREATE TABLE IF NOT EXISTS alphabets (fingerprint TEXT PRIMARY KEY, symbols TEXT NOT NULL, examples TEXT NOT NULL)")
+        # version of the alphabet last written, see MessageParserData.version
+        self.alphabet_version = None
+
+    @staticmethod
+    def config_fingerprint(config: dict) -> str:
+        """hash of the SUT and mitm controllers, the slime_config entries in FINGERPRINT_SLIME_CONFIG, the custom module and slime's own parsers and fuzzers"""
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps([
+            config["sut_controllers"],
+            config["mitm_controllers"],
+            {k: config["slime_config"].get(k) for k in FINGERPRINT_SLIME_CONFIG}
+        ], sort_keys=True).encode())
+        fnames = [os.path.join(os.path.dirname(__file__), fname) for fname in ["msgparser.py", "msgfuzzer.py", "mitmman.py"]]
+        if config["slime_config"].get("custom_module"):
+            fnames.append(config["slime_config"]["custom_module"])
+        for fname in fnames:
+            with open(fname, "rb") as f:
+                fingerprint.update(f.read())
+        return fingerprint.hexdigest()
+
+    def load(self):
+        """(query, response, plaid_msg) of every stored query"""
+        return self.db.execute("SELECT query, response, plaid_msg FROM queries WHERE fingerprint = ?", (self.fingerprint,))
+
+    def load_alphabet(self) -> tuple:
+        row = self.db.execute("SELECT symbols, examples FROM alphabets WHERE fingerprint = ?", (self.fingerprint,)).fetchone()
+        if row is None:
+            return {}, {}
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, query: str, response: str, plaid_msg: str, symbols: dict, examples: dict, version: int = None):
+        """store a query, the alphabet is only written again if its version changed (always without a version)"""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)", (self.fingerprint, query, response, plaid_msg))
+            if version is None or version != self.alphabet_version:
+                self.db.execute("INSERT OR REPLACE INTO alphabets VALUES (?, ?, ?)", (self.fingerprint, json.dumps(symbols), json.dumps(examples)))
+                self.alphabet_version = version
+
+    def close(self):
+        self.db.close()
+
+
+class QueryTrieNode:
+    __slots__ = ("symbol", "children", "output", "cached", "sink", "plaid", "observed")
+
+    def __init__(self, symbol: str = None):
+        self.symbol = symbol  # last input symbol of this prefix
+        # None, the only child, or input symbol -> QueryTrieNode once there are several, most nodes have a single child and a dict each would double the memory
+        self.children = None
+        self.output = None  # output symbol of the last input symbol of this prefix
+        self.cached = False  # whether this prefix has a cached response (queries and their prefixes of 2 or more symbols)
+        self.sink = None  # "term" or "noflow" if every output after this prefix is the same (ludicrous speed)
+        self.plaid = None  # PlaidClass of this query (plaid)
+        self.observed = 0  # measured queries that only repeat this output after this prefix, -1 once one didn't (learned sinks)
+
+
+class QueryTrie:
+    """query cache keyed on input symbols, one node per prefix so shared prefixes are stored once and lookups are a single walk"""
+    def __init__(self):
+        self.root = QueryTrieNode()
+        self.nodes = 1
+
+    @staticmethod
+    def child(node: QueryTrieNode, symbol: str) -> QueryTrieNode:
+        children = node.children
+        if children is None:
+            return None
+        if type(children) == dict:
+            return children.get(symbol)
+        return children if children.symbol == symbol else None
+
+    @staticmethod
+    def children_of(node: QueryTrieNode) -> tuple:
+        children = node.children
+        if children is None:
+            return ()
+        return children.values() if type(children) == dict else (children,)
+
+    def add(self, node: QueryTrieNode, symbol: str) -> QueryTrieNode:
+        child = self.child(node, symbol)
+        if child is None:
+            child = QueryTrieNode(sys.intern(symbol))
+            if node.children is None:
+                node.children = child
+            elif type(node.children) == dict:
+                node.children[child.symbol] = child
+            else:
+                node.children = {node.children.symbol: node.children, child.symbol: child}
+            self.nodes += 1
+        return child
+
+    def insert(self, query_split: list, response_split: list) -> list:
+        """store the outputs of a query, returns the nodes along its path"""
+        node = self.root
+        path = []
+        for symbol, output in zip(query_split, response_split):
+            node = self.add(node, symbol)
+            node.output = sys.intern(output)
+            path.append(node)
+        return path
+
+    def walk(self, query_split: list, node: QueryTrieNode = None) -> tuple:
+        """(nodes along the cached part of the query, depth of the deepest sink on a proper prefix, that sink), from the root or another node"""
+        node = node or self.root
+        path = []
+        sink_depth, sink = 0, None
+        child = self.child
+        for depth, symbol in enumerate(query_split, 1):
+            node = child(node, symbol)
+            if node is None:
+                break
+            path.append(node)
+            if node.sink is not None and depth < len(query_split):
+                sink_depth, sink = depth, node.sink
+        return path, sink_depth, sink
+
+
+class PlaidNode:
+    __slots__ = ("node", "extra")
+
+    def __init__(self, node: QueryTrieNode):
+        self.node = node  # trie node of one query of the class at this position
+        self.extra = {}  # input symbol -> continuations of other queries of the class, taken before the children of node
+
+
+class PlaidClass:
+    """cached queries with the same plaid message and length, everything after them is merged into one continuation per input symbol
+    the continuation points into the trie and only wraps the nodes where the queries of the class part ways, so nothing is copied and a lookup is a single walk"""
+    __slots__ = ("members", "continued")
+
+    def __init__(self):
+        self.members = {}  # trie node -> None, ordered set of the queries in the class
+        self.continued = {}  # input symbol -> trie node or PlaidNode
+
+    @staticmethod
+    def step(position, symbol: str):
+        if type(position) == PlaidNode:
+            following = position.extra.get(symbol)
+            return following if following is not None else QueryTrie.child(position.node, symbol)
+        return QueryTrie.child(position, symbol)
+
+    def join(self, node: QueryTrieNode):
+        self.members[node] = None
+        # every path down to a leaf, the continuation is merged one path at a time
+        stack = [[child] for child in QueryTrie.children_of(node)]
+        while stack:
+            path = stack.pop()
+            children = QueryTrie.children_of(path[-1])
+            if children:
+                stack.extend(path + [child] for child in children)
+            else:
+                self.extend(path, 0)
+
+    def leave(self, node: QueryTrieNode):
+        """the continuations don't know which query they came from, they are merged again from the rest of the class"""
+        self.members.pop(node, None)
+        self.continued = {}
+        for member in list(self.members):
+            self.join(member)
+
+    def extend(self, path: list, start: int):
+        """a query of the class was continued along path[start:]"""
+        holder, symbol = self.continued, path[start].symbol
+        position = holder.get(symbol)
+        if position is None:
+            holder[symbol] = path[start]
+            return
+        # trie nodes reached since the last PlaidNode, they are wrapped if another query of the class goes further below them
+        unwrapped = [] if type(position) == PlaidNode else [position]
+        for i in range(start, len(path)):
+            if position is path[i] or (type(position) == PlaidNode and position.node is path[i]):
+                return  # the rest is this very part of the trie
+            if i + 1 == len(path):
+                return
+            symbol = path[i + 1].symbol
+            following = self.step(position, symbol)
+            if following is None:
+                if unwrapped:
+                    position = holder[unwrapped[0].symbol] = PlaidNode(unwrapped[0])
+                    for node in unwrapped[1:]:
+                        position.extra[node.symbol] = PlaidNode(node)
+                        position = position.extra[node.symbol]
+                position.extra[symbol] = path[i + 1]
+                return
+            if type(position) == PlaidNode:
+                holder, unwrapped = position.extra, []
+            position = following
+            if type(position) != PlaidNode:
+                unwrapped.append(position)
+
+    def lookup(self, suffix_split: list, ludicrous_speed: bool) -> list:
+        """outputs of the suffix after a query of the class, None if no query of the class was continued like that"""
+        position = self.continued.get(suffix_split[0])
+        path = []
+        sink_depth, sink = 0, None
+        for depth, symbol in enumerate(suffix_split, 1):
+            if depth > 1:
+                position = self.step(position, symbol)
+            if position is None:
+                break
+            node = position.node if type(position) == PlaidNode else position
+            path.append(node)
+            if node.sink is not None and depth < len(suffix_split):
+                sink_depth, sink = depth, node.sink
+        if len(path) == len(suffix_split) and path[-1].cached:
+            return [node.output for node in path]
+        if ludicrous_speed and sink is not None:
+            return [node.output for node in path[:sink_depth]] + [sink] * (len(suffix_split) - sink_depth)
+        return None
+
+
 class LearnlibCommandLog:
-    def __init__(self, resume = False, time = False, ludicrous_speed = False, plaid = False):
+    def __init__(self, resume = False, time = False, ludicrous_speed = False, plaid = False, sink_symbols = None, sink_observations = 0, sink_verify_rate = 0.0):
         if resume:
             assert not os.path.exists("logs/log.pickle.bak")
             os.rename("logs/log.pickle", "logs/log.pickle.bak")
@@ -102,80 +375,198 @@ class LearnlibCommandLog:
         self.time_file = open("logs/time_log.csv", "w", newline='')
         self.time_writer = csv.writer(self.time_file)
         self.log_entry = {"timestamp":{}}
-        self.lookup_dict = {}
-        self.ludicrous_lookup = {}
-        self.plaid_lookup = {}
-        self.plaid_equivalencies = collections.defaultdict(set)
+        self.trie = QueryTrie()
+        # queries whose response has a different number of symbols than the query can't be split over the trie
+        self.irregular_lookup = {}
+        # (plaid message, query length) -> PlaidClass
+        self.plaid_index = {}
+        self.plaid_lookups = 0
+        self.plaid_hits = 0
         self.time = time
         self.ludicrous_speed = ludicrous_speed
         self.plaid = plaid
+        # output symbols (regular expressions) that end a session like term (ludicrous speed)
+        self.sink_symbols = re.compile("|".join("(?:%s)" % symbol for symbol in sink_symbols)) if sink_symbols else None
+        # a prefix continued by this many measured queries with only its last output becomes a sink, a fraction of the queries answered from learned sinks is measured anyway (ludicrous speed)
+        self.sink_observations = sink_observations
+        self.sink_verify_rate = sink_verify_rate
+        self.learned_sinks = set()
+        self.sink_verifications = 0
+        self.sink_mistakes = 0
 
-    def resume_next(self) -> tuple:
-        try:
-            self.log_entry = pickle.load(self.old_log_file)
-            return self.log_entry["query"], self.log_entry["response"]
-        except Exception:
-            self.old_log_file.close()
-            return None, None
+    def resume(self) -> int:
+        """copy the previous log.pickle over as is and load all of its entries into the cache in one pass, returns the number of entries
+        the learner's queries are then answered from the cache in whatever order it asks them instead of replaying the log in lockstep"""
+        entries = 0
+        log_rows = []
+        time_rows = []
+        clean = False
+        unpickler = pickle.Unpickler(self.old_log_file)
+        while True:
+            try:
+                self.log_entry = unpickler.load()
+            except EOFError:
+                clean = True
+                break
+            except Exception:
+                # eg cut off by a crash while writing, everything before is still good
+                break
+            log_row, time_row = self.rows()
+            log_rows.append(log_row)
+            time_rows.append(time_row)
+            self.cache_query()
+            entries += 1
+        self.log_writer.writerows(log_rows)
+        self.csv_file.flush()
+        self.time_writer.writerows(time_rows)
+        self.time_file.flush()
+        self.old_log_file.seek(0)
+        if clean:
+            # no need to pickle every entry again
+            shutil.copyfileobj(self.old_log_file, self.pickle_file)
+        else:
+            unpickler = pickle.Unpickler(self.old_log_file)
+            for i in range(entries):
+                pickle.dump(unpickler.load(), self.pickle_file)
+        self.pickle_file.flush()
+        self.old_log_file.close()
+        self.new_entry()
+        return entries
 
-    def lookup_query(self, query, plaid_recursion = False) -> str:
+    def lookup_query(self, query, plaid_recursion = False, speculative = False) -> str:
         query_split = query.split(";")
-        if query in self.lookup_dict:
-            return self.lookup_dict[query]
-        if self.ludicrous_speed:
-            for i in range(1, len(query_split)):
-                short_query = ";".join(query_split[:-i])
-                if short_query in self.ludicrous_lookup:
-                    response, end = self.ludicrous_lookup[short_query]
-                    print("light speed, too slow?")
-                    return response + (";" + end) * i
+        if query in self.irregular_lookup:
+            return self.irregular_lookup[query]
+        # walk the trie once, collecting outputs and remembering the deepest sink on a proper prefix
+        path, sink_depth, sink = self.trie.walk(query_split)
+        if len(path) == len(query_split) and path[-1].cached:
+            return ";".join([node.output for node in path])
+        if self.ludicrous_speed and sink is not None:
+            if speculative:
+                return ";".join([node.output for node in path[:sink_depth]] + [sink] * (len(query_split) - sink_depth))
+            if self.sink_verify_rate and path[sink_depth - 1] in self.learned_sinks and random.random() < self.sink_verify_rate:
+                self.sink_verifications += 1
+                print("verifying learned sink")
+                return None
+            print("light speed, too slow?")
+            return ";".join([node.output for node in path[:sink_depth]] + [sink] * (len(query_split) - sink_depth))
         if self.plaid and not plaid_recursion:
-            for i in range(1, len(query_split)):
-                short_query = ";".join(query_split[:-i])
-                if short_query in self.plaid_lookup:
-                    plaid_msg = self.plaid_lookup[short_query]
-                    for short_equivalent_query in self.plaid_equivalencies[plaid_msg]:
-                        if short_query == short_equivalent_query:
-                            continue
-                        equivalent_query = short_equivalent_query + ";" + ";".join(query_split[-i:])
-                        if len(equivalent_query.split(";")) != len(query_split):
-                            continue
-                        response = self.lookup_query(equivalent_query, plaid_recursion=True)
-                        if response is not None:
-                            print("they've gone to plaid!")
-                            return response
+            # longest prefix first, a prefix that was queried itself knows its plaid class, the rest of the query is looked up in that class
+            if not speculative:
+                self.plaid_lookups += 1
+            for i in range(min(len(path), len(query_split) - 1), 0, -1):
+                plaid_class = path[i - 1].plaid
+                if plaid_class is None:
+                    continue
+                response = plaid_class.lookup(query_split[i:], self.ludicrous_speed)
+                if response is not None:
+                    if not speculative:
+                        self.plaid_hits += 1
+                        print("they've gone to plaid!")
+                    return ";".join([node.output for node in path[:i]] + response)
         return None
 
+    def is_sink(self, output: str) -> bool:
+        """whether an output symbol is one of the configured sink symbols"""
+        return self.sink_symbols is not None and self.sink_symbols.fullmatch(output) is not None
+
+    def observe_sinks(self, path: list, response_split: list):
+        """count measured queries that continue a prefix with nothing but its last output, a prefix seen sink_observations times like that becomes a sink"""
+        # outputs from consistent onwards are all the same
+        consistent = len(response_split) - 1
+        while consistent > 0 and response_split[consistent - 1] == response_split[-1]:
+            consistent -= 1
+        for depth, node in enumerate(path[:-1]):
+            if node.observed < 0:
+                continue
+            if depth < consistent:
+                if node in self.learned_sinks:
+                    self.learned_sinks.remove(node)
+                    node.sink = None
+                    self.sink_mistakes += 1
+                    print("learned sink %s after %s symbols was wrong" % (node.output, depth + 1))
+                node.observed = -1
+            else:
+                node.observed += 1
+                if node.observed == self.sink_observations and node.sink is None:
+                    node.sink = node.output
+                    self.learned_sinks.add(node)
+                    print("learned sink %s after %s symbols" % (node.output, depth + 1))
+
+    def sink_report(self) -> str:
+        return "Sinks: %s learned, %s verification queries, %s wrong" % (len(self.learned_sinks) + self.sink_mistakes, self.sink_verifications, self.sink_mistakes)
+
+    def plaid_report(self) -> str:
+        return "Plaid: %s hits in %s cache misses (%.1f%%), %s classes" % (self.plaid_hits, self.plaid_lookups, 100 * self.plaid_hits / max(self.plaid_lookups, 1), len(self.plaid_index))
+
+    def preload(self, entries) -> int:
+        """add (query, response, plaid_msg) entries to the cache without logging them, eg from the query store"""
+        count = 0
+        for query, response, plaid_msg in entries:
+            self.log_entry = {"timestamp": {}, "query": query, "response": response, "plaid_msg": plaid_msg}
+            self.cache_query()
+            count += 1
+        self.new_entry()
+        return count
+
     def cache_query(self):
         query, response = self.log_entry["query"], self.log_entry["response"]
         query_split, response_split = query.split(";"), response.split(";")
-        self.lookup_dict[query] = response
-        for i in range(1, len(query_split) - 1):
-            self.lookup_dict[";".join(query_split[:-i])] = ";".join(response_split[:-i])
-        if self.ludicrous_speed:
-            if "term" in response:
-                # This is a little safer, may use a separate flag from the next two, or just use always
-                i = response_split.index("term") + 1
-                self.ludicrous_lookup[";".join(query_split[:i])] = (";".join(response_split[:i]), "term")
-            # elif "errorres" in response:
-            #     # Handle same as term
-            #     i = response_split.index("errorres") + 1
-            #     self.ludicrous_lookup[";".join(query_split[:i])] = (";".join(response_split[:i]), "errorres")
-            # elif "errorreq" in response:
-            #     # Handle same as term
-            #     i = response_split.index("errorreq") + 1
-            #     self.ludicrous_lookup[";".join(query_split[:i])] = (";".join(response_split[:i]), "errorreq")
-            elif "noflow" in response:
-                # warning, this might not always be true (for all systems tested so far it is true), assumes communication does not resume/restart after a noflow
-                i = response_split.index("noflow") + 1
-                self.ludicrous_lookup[";".join(query_split[:i])] = (";".join(response_split[:i]), "noflow")
-            elif response_split[-1].split("-")[-1] == "null":
-                # TODO Create flag for null request terminates as noflow
-                # warning, this might not always be true (for all systems tested so far it is true), assumes communication does not resume/restart after a noflow
-                self.ludicrous_lookup[query] = (response, "noflow")
-        if self.plaid and "plaid_msg" in self.log_entry and self.log_entry["plaid_msg"]:
-            self.plaid_lookup[self.log_entry["query"]] = self.log_entry["plaid_msg"]
-            self.plaid_equivalencies[self.log_entry["plaid_msg"]].add(self.log_entry["query"])
+        if len(query_split) != len(response_split):
+            self.irregular_lookup[query] = response
+            for i in range(1, len(query_split) - 1):
+                self.irregular_lookup[";".join(query_split[:-i])] = ";".join(response_split[:-i])
+        else:
+            path = self.trie.insert(query_split, response_split)
+            path[-1].cached = True
+            # prefixes of 2 or more symbols are answered from the cache, same as before the trie
+            for node in path[1:-1]:
+                node.cached = True
+            if self.ludicrous_speed:
+                sink = next((i for i, output in enumerate(response_split) if self.is_sink(output)), None) if self.sink_symbols else None
+                if sink is not None:
+                    path[sink].sink = response_split[sink]
+                elif "term" in response:
+                    # This is a little safer, may use a separate flag from the next two, or just use always
+                    i = response_split.index("term") + 1
+                    path[i - 1].sink = "term"
+                # elif "errorres" in response:
+                #     # Handle same as term
+                #     i = response_split.index("errorres") + 1
+                #     path[i - 1].sink = "errorres"
+                # elif "errorreq" in response:
+                #     # Handle same as term
+                #     i = response_split.index("errorreq") + 1
+                #     path[i - 1].sink = "errorreq"
+                elif "noflow" in response:
+                    # warning, this might not always be true (for all systems tested so far it is true), assumes communication does not resume/restart after a noflow
+                    i = response_split.index("noflow") + 1
+                    path[i - 1].sink = "noflow"
+                elif response_split[-1].split("-")[-1] == "null":
+                    # TODO Create flag for null request terminates as noflow
+                    # warning, this might not always be true (for all systems tested so far it is true), assumes communication does not resume/restart after a noflow
+                    path[-1].sink = "noflow"
+                # only responses measured on the SUTs count, not cache hits
+                if self.sink_observations and self.log_entry.get("transition_times") != "":
+                    self.observe_sinks(path, response_split)
+            if self.plaid:
+                self.index_plaid(path, self.log_entry.get("plaid_msg"))
+
+    def index_plaid(self, path: list, plaid_msg: str):
+        """add a cached query to its plaid class, and merge what follows each of its prefixes into the continuations of their classes"""
+        if plaid_msg:
+            key = (plaid_msg, len(path))
+            plaid_class = self.plaid_index.get(key)
+            if plaid_class is None:
+                plaid_class = self.plaid_index[key] = PlaidClass()
+            if path[-1].plaid is not plaid_class:
+                if path[-1].plaid is not None:
+                    path[-1].plaid.leave(path[-1])
+                path[-1].plaid = plaid_class
+                plaid_class.join(path[-1])
+        for i in range(1, len(path)):
+            if path[i - 1].plaid is not None:
+                path[i - 1].plaid.extend(path, i)
 
     def new_entry(self):
         """create an empty dict for the new entry"""
@@ -189,19 +580,23 @@ class LearnlibCommandLog:
         self.pickle_file.close()
         self.csv_file.close()
 
+    def rows(self) -> tuple:
+        """rows for log.csv and time_log.csv of the current entry"""
+        if self.time:
+            log_row = [self.log_entry["query"], self.log_entry["timestamp"]["query"], self.log_entry["response"], self.log_entry["timestamp"]["response"]]
+        else:
+            log_row = [self.log_entry["query"], self.log_entry["response"]]
+        return log_row, [self.log_entry["query"], self.log_entry["transition_times"]]
+
     def write_entry(self, used_query):
         # todo: this will just dump (append) current entries to file
         if "query" in self.log_entry and "response" in self.log_entry:
             # write entry
             self.log_entry["used_query"] = used_query
-            if self.time:
-                row = [self.log_entry["query"], self.log_entry["timestamp"]["query"], self.log_entry["response"], self.log_entry["timestamp"]["response"]]
-            else:
-                row = [self.log_entry["query"], self.log_entry["response"]]
-            self.log_writer.writerow(row)
+            log_row, time_row = self.rows()
+            self.log_writer.writerow(log_row)
             self.csv_file.flush()
-            row = [self.log_entry["query"], self.log_entry["transition_times"]]
-            self.time_writer.writerow(row)
+            self.time_writer.writerow(time_row)
             self.time_file.flush()
             pickle.dump(self.log_entry, self.pickle_file)
             self.pickle_file.flush()
@@ -209,3 +604,161 @@ class LearnlibCommandLog:
             self.new_entry()
         else:
             print("LOG ERROR: " + str(self.log_entry.keys()))
+
+
+class Speculator:
+    """predicts the learner's next queries, one symbol extensions of its recent queries, so idle replicas can run them while the learner is busy"""
+    def __init__(self, budget: int, reserve: int = 0, recent: int = 32):
+        self.budget = budget  # speculative queries per wait for the learner
+        self.reserve = reserve  # replicas left free for the learner, with none free a speculative session is aborted for a query from the learner
+        self.recent = collections.deque(maxlen=recent)
+        self.alphabet = {}  # input symbols in the order the learner first used them
+        self.speculated = {}  # query -> session time, finished speculative queries the learner hasn't asked yet
+        self.idle_runs = 0
+        self.runs = 0
+        self.aborted = 0
+        self.hits = 0
+        self.saved = 0.0
+
+    def observe(self, query: str):
+        """query from the learner, returns whether it was speculated"""
+        self.idle_runs = 0
+        if query in self.recent:
+            self.recent.remove(query)
+        self.recent.appendleft(query)
+        for symbol in query.split(";"):
+            self.alphabet.setdefault(symbol)
+        if query in self.speculated:
+            self.hit(self.speculated.pop(query))
+            return True
+        return False
+
+    def hit(self, saved: float):
+        self.hits += 1
+        self.saved += saved
+
+    def next_query(self, known) -> str:
+        """most likely next query that isn't known yet (known(query) -> bool), None if there is none or the budget is used up"""
+        if self.idle_runs >= self.budget:
+            return None
+        for query in self.recent:
+            for symbol in self.alphabet:
+                candidate = query + ";" + symbol
+                if candidate not in self.speculated and not known(candidate):
+                    self.idle_runs += 1
+                    self.runs += 1
+                    return candidate
+        return None
+
+    def report(self) -> str:
+        return "Speculation: %s queries run (%s aborted), %s asked by the learner later (%.1f%%), saved about %.0fs" % (self.runs, self.aborted, self.hits, 100 * self.hits / max(self.runs - self.aborted, 1), self.saved)
+
+
+class LatencyModel:
+    """latency of the next message per (query prefix, action, stage of the action), listen timeouts are set from the observed latencies instead of one static mitm_timeout
+    prefixes without enough samples fall back to all prefixes with the same action and stage, then to the static timeout"""
+    def __init__(self, fname: str, quantile: float = 0.99, margin: float = 2.0, min_samples: int = 5, samples: int = 32):
+        self.fname = fname
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.samples = samples
+        self.latencies = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                for key, latencies in json.load(f).items():
+                    self.latencies[key] = collections.deque(latencies, maxlen=samples * 8 if key.startswith("*|") else samples)
+        self.lock = threading.Lock()  # shared by the replicas
+        self.timeouts = 0
+        self.saved = 0.0
+
+    def keys(self, prefix: str, action: str, stage: int) -> tuple:
+        return "%s|%s|%s" % (prefix, action, stage), "*|%s|%s" % (action, stage)
+
+    def timeout(self, prefix: str, action: str, stage: int, static: float, minimum: float = 0.0) -> float:
+        with self.lock:
+            for key in self.keys(prefix, action, stage):
+                latencies = self.latencies.get(key)
+                if latencies is not None and len(latencies) >= self.min_samples:
+                    latencies = sorted(latencies)
+                    latency = latencies[min(int(self.quantile * len(latencies)), len(latencies) - 1)]
+                    return min(static, max(minimum, latency * self.margin))
+        return static
+
+    def observe(self, prefix: str, action: str, stage: int, latency: float):
+        with self.lock:
+            key, any_prefix = self.keys(prefix, action, stage)
+            if key not in self.latencies:
+                self.latencies[key] = collections.deque(maxlen=self.samples)
+            if any_prefix not in self.latencies:
+                self.latencies[any_prefix] = collections.deque(maxlen=self.samples * 8)
+            self.latencies[key].append(latency)
+            self.latencies[any_prefix].append(latency)
+
+    def timed_out(self, saved: float):
+        """a listen timed out, saved is how much shorter the timeout was than the static one"""
+        with self.lock:
+            self.timeouts += 1
+            self.saved += saved
+
+    def save(self):
+        with self.lock:
+            with open(self.fname, "w") as f:
+                json.dump({key: list(latencies) for key, latencies in self.latencies.items()}, f)
+
+    def report(self) -> str:
+        return "Adaptive timeouts: %s timeouts, %.1fs shorter than with the static timeout" % (self.timeouts, self.saved)
+
+
+class QuiescenceDetector:
+    """decides a listen will time out before it does, from the SUTs using no cpu, doing no io and keeping the same connections for several samples in a row while nothing arrives from the mitm
+    a fraction of the early decisions is verified by listening until the real timeout, every one that turns out wrong makes the detector wait longer and for more samples"""
+    def __init__(self, interval: float = 0.1, samples: int = 3, min_wait: float = 0.5, cpu_tolerance: float = 0.01, verify_rate: float = 0.05):
+        self.interval = interval
+        self.samples = samples
+        self.min_wait = min_wait
+        self.cpu_tolerance = cpu_tolerance
+        self.verify_rate = verify_rate
+        self.lock = threading.Lock()  # shared by the replicas
+        self.early = 0
+        self.saved = 0.0
+        self.verifications = 0
+        self.mistakes = 0
+
+    def quiet(self, before: dict, after: dict) -> bool:
+        """whether no SUT did anything between two samples of {sut name: (cpu seconds, io bytes, connections)}, never if a SUT can't be sampled"""
+        if not before or not after or before.keys() != after.keys():
+            return False
+        for name in after:
+            if before[name] is None or after[name] is None:
+                return False
+            if after[name][0] - before[name][0] > self.cpu_tolerance or after[name][1:] != before[name][1:]:
+                return False
+        return True
+
+    def decide(self, quiet: int, waited: float) -> bool:
+        with self.lock:
+            return quiet >= self.samples and waited >= self.min_wait
+
+    def verify(self) -> bool:
+        """whether to check this early decision by listening until the real timeout"""
+        if random.random() < self.verify_rate:
+            with self.lock:
+                self.verifications += 1
+            return True
+        return False
+
+    def verified(self, wrong: bool):
+        if wrong:
+            with self.lock:
+                self.mistakes += 1
+                self.min_wait *= 2
+                self.samples += 1
+
+    def decided(self, saved: float):
+        with self.lock:
+            self.early += 1
+            self.saved += saved
+
+    def report(self) -> str:
+        return "Quiescence: %s early timeouts, %.1fs saved, %s of %s verified wrong (now %s samples over at least %.2fs)" % (self.early, self.saved, self.mistakes, self.verifications, self.samples, self.min_wait)